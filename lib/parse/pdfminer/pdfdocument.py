@@ -2,11 +2,15 @@
 import sys
 import re
 import struct
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
 try:
     import hashlib as md5
 except ImportError:
     import md5
 from psparser import PSEOF
+from psparser import map_input
 from psparser import literal_name
 from psparser import LIT, KWD, STRICT
 from pdftypes import PDFException, PDFTypeError, PDFNotImplementedError
@@ -17,7 +21,7 @@ from pdftypes import str_value, list_value, dict_value, stream_value
 from pdfparser import PDFSyntaxError
 from pdfparser import PDFStreamParser
 from arcfour import Arcfour
-from utils import choplist, nunpack
+from utils import choplist
 from utils import decode_text
 
 
@@ -47,6 +51,45 @@ LITERAL_XREF = LIT('XRef')
 LITERAL_CATALOG = LIT('Catalog')
 
 
+def unpack_int(s, default=0):
+    """Unpacks a big endian integer of any length, like nunpack."""
+    if not s:
+        return default
+    return int(s.encode('hex'), 16)
+
+
+def unpack_columns(data, widths, count):
+    """Unpacks count records of big endian unsigned integer fields.
+
+    Returns one list of values per field, None for a field of width 0.
+    The records are read with a single struct format, fields wider
+    than 4 bytes are put together from 4, 2 and 1 byte parts.
+    """
+    fmt = ''
+    parts = []
+    for w in widths:
+        sizes = []
+        while w:
+            size = 4 if 4 <= w else 2 if 2 <= w else 1
+            fmt += {4: 'L', 2: 'H', 1: 'B'}[size]
+            sizes.append(size)
+            w -= size
+        parts.append(sizes)
+    values = struct.unpack_from('>'+fmt*count, data)
+    columns = []
+    first = 0
+    for sizes in parts:
+        if not sizes:
+            columns.append(None)
+            continue
+        column = values[first::len(fmt)]
+        for (i, size) in enumerate(sizes[1:], first+1):
+            column = [(v << 8*size) | p for (v, p) in zip(column, values[i::len(fmt)])]
+        columns.append(list(column))
+        first += len(sizes)
+    return columns
+
+
 ##  XRefs
 ##
 class PDFBaseXRef(object):
@@ -96,6 +139,8 @@ class PDFXRef(PDFBaseXRef):
                 (start, nobjs) = map(long, f)
             except ValueError:
                 raise PDFNoValidXRef('Invalid line: %r: line=%r' % (parser, line))
+            if self.load_entries(parser, start, nobjs):
+                continue
             for objid in xrange(start, start+nobjs):
                 try:
                     (_, line) = parser.nextline()
@@ -113,6 +158,32 @@ class PDFXRef(PDFBaseXRef):
         self.load_trailer(parser)
         return
 
+    XREF_ENTRIES = re.compile(r'(?:\d{10} \d{5} [fn](?: \r| \n|\r\n))*')
+
+    def load_entries(self, parser, start, nobjs):
+        """Loads a subsection of standard 20 byte entries with one read.
+
+        Returns False, having consumed nothing, when the subsection is
+        not made of exactly nobjs such entries, which load then reads
+        line by line.
+        """
+        if nobjs <= 0:
+            return False
+        pos = parser.tell()
+        size = 20*nobjs
+        block = parser.read_n_from(pos, size+1)
+        if self.XREF_ENTRIES.match(block).end(0) != size:
+            return False
+        if len(block) == size and block.endswith('\r'):
+            # nextline() would hit EOF looking for a \n after the last \r
+            return False
+        for (i, objid) in enumerate(xrange(start, start+nobjs)):
+            k = 20*i
+            if block[k+17] == 'n':
+                self.offsets[objid] = (None, long(block[k:k+10]), int(block[k+11:k+16]))
+        parser.seek(pos+size)
+        return True
+
     KEYWORD_TRAILER = KWD('trailer')
 
     def load_trailer(self, parser):
@@ -148,29 +219,52 @@ class PDFXRefFallback(PDFXRef):
     def __repr__(self):
         return '<PDFXRefFallback: offsets=%r>' % (self.offsets.keys())
 
-    PDFOBJ_CUE = re.compile(r'^(\d+)\s+(\d+)\s+obj\b')
+    # An object header or trailer at the start of a line, as nextline() splits
+    # them, and only on a line that nextline() returns, i.e. one with an EOL
+    # that does not end the file with a lone \r.
+    LINE_CUE = re.compile(r'(?:^|(?<=\n)|(?<=\r)(?!\n))'
+                          r'(?:(\d+)[^\S\r\n]+(\d+)[^\S\r\n]+obj\b|(trailer))'
+                          r'(?=[^\r\n]*(?:\n|\r.))', re.DOTALL)
+    OBJSTM_CUE = re.compile(r'/Type\s*/ObjStm\b')
+    STREAM_CUE = re.compile(r'\b(?:(stream)|endobj)\b')
 
     def load(self, parser, debug=0):
-        parser.seek(0)
-        while 1:
-            try:
-                (pos, line) = parser.nextline()
-            except PSEOF:
-                break
-            if line.startswith('trailer'):
-                parser.seek(pos)
+        """Finds every object header up to the first trailer in one scan of the
+        file, and only parses the objects whose dictionary looks like an ObjStm.
+
+        Stream data is skipped up to its endstream, so that headers or
+        trailers in there never replace the objects of the file.
+        """
+        data = parser.data
+        if data is None:
+            data = map_input(parser.fp)
+        cues = []
+        m = self.LINE_CUE.search(data)
+        while m:
+            if m.group(3):
+                parser.seek(m.start(0))
                 self.load_trailer(parser)
                 if 1 <= debug:
                     print >>sys.stderr, 'trailer: %r' % self.get_trailer()
                 break
-            m = self.PDFOBJ_CUE.match(line)
-            if not m:
-                continue
-            (objid, genno) = m.groups()
-            objid = int(objid)
-            genno = int(genno)
+            cues.append((m.start(0), m.end(0), int(m.group(1)), int(m.group(2))))
+            n = self.LINE_CUE.search(data, m.end(0))
+            # a stream keyword before the next header or endobj starts stream data
+            s = self.STREAM_CUE.search(data, m.end(0), n.start(0) if n else len(data))
+            if s and s.group(1):
+                e = data.find('endstream', s.end(0))
+                if e == -1:
+                    break
+                if n and n.start(0) < e:
+                    n = self.LINE_CUE.search(data, e)
+            m = n
+        for (i, (pos, end, objid, genno)) in enumerate(cues):
             self.offsets[objid] = (None, pos, genno)
-            # expand ObjStm.
+            # expand ObjStm, peeking at the dictionary up to its stream or the next object
+            stop = cues[i+1][0] if i+1 < len(cues) else len(data)
+            body = data.find('stream', end, stop)
+            if not self.OBJSTM_CUE.search(data, end, stop if body == -1 else body):
+                continue
             parser.seek(pos)
             (_, obj) = parser.nextobject()
             if isinstance(obj, PDFStream) and obj.get('Type') is LITERAL_OBJSTM:
@@ -181,7 +275,7 @@ class PDFXRefFallback(PDFXRef):
                     if STRICT:
                         raise PDFSyntaxError('N is not defined: %r' % stream)
                     n = 0
-                parser1 = PDFStreamParser(stream.get_data())
+                parser1 = PDFStreamParser(stream.get_data(), mapped=parser.data is not None)
                 objs = []
                 try:
                     while 1:
@@ -200,11 +294,24 @@ class PDFXRefFallback(PDFXRef):
 ##
 class PDFXRefStream(PDFBaseXRef):
 
+    """An xref stream, decoded once by load into one array per field.
+
+    types holds 1 or 2 for the entries in use and 0 for the others.
+    Entries past the end of the stream data are not stored, they read
+    as type 1 at position 0, as nunpack of an empty entry gives.
+    get_pos finds the range of an objid by bisecting the sorted range
+    starts, unless ranges overlap, when the first that holds it wins.
+    """
+
     def __init__(self):
         self.data = None
         self.entlen = None
         self.fl1 = self.fl2 = self.fl3 = None
         self.ranges = []
+        self.starts = None
+        self.spans = []
+        self.types = array('B')
+        self.fields2 = self.fields3 = array('L')
         return
 
     def __repr__(self):
@@ -226,40 +333,95 @@ class PDFXRefStream(PDFBaseXRef):
         self.data = stream.get_data()
         self.entlen = self.fl1+self.fl2+self.fl3
         self.trailer = stream.attrs
+        self.decode()
+        self.index_ranges()
         if 1 <= debug:
             print >>sys.stderr, ('xref stream: objid=%s, fields=%d,%d,%d' %
                                  (', '.join(map(repr, self.ranges)),
                                  self.fl1, self.fl2, self.fl3))
         return
 
+    def decode(self):
+        nentries = sum(nobjs for (_, nobjs) in self.ranges)
+        full = min(nentries, len(self.data) // self.entlen) if self.entlen else 0
+        (types, fields2, fields3) = unpack_columns(self.data, (self.fl1, self.fl2, self.fl3), full)
+        types = types or [1]*full
+        fields2 = fields2 or [0]*full
+        fields3 = fields3 or [0]*full
+        offset = self.entlen * full
+        if full < nentries and offset < len(self.data):
+            # a last entry cut short
+            ent = self.data[offset:offset+self.entlen]
+            types.append(unpack_int(ent[:self.fl1], 1))
+            fields2.append(unpack_int(ent[self.fl1:self.fl1+self.fl2]))
+            fields3.append(unpack_int(ent[self.fl1+self.fl2:]))
+        self.types = array('B', [t if t == 1 or t == 2 else 0 for t in types])
+        try:
+            self.fields2 = array('L', fields2)
+            self.fields3 = array('L', fields3)
+        except OverflowError:
+            self.fields2 = fields2
+            self.fields3 = fields3
+        return
+
+    def index_ranges(self):
+        """Sorts the (start, nobjs, first entry) of each range by start.
+
+        starts stays None when ranges overlap.
+        """
+        index = 0
+        spans = []
+        for (start, nobjs) in self.ranges:
+            if 0 < nobjs:
+                spans.append((start, nobjs, index))
+            index += nobjs
+        spans.sort()
+        for ((start, nobjs, _), (next_start, _, _)) in zip(spans, spans[1:]):
+            if next_start < start+nobjs:
+                return
+        self.spans = spans
+        self.starts = [start for (start, _, _) in spans]
+        return
+
     def get_trailer(self):
         return self.trailer
 
     def get_objids(self):
+        # Each range reads the types from the first entry on, as it always has
         for (start, nobjs) in self.ranges:
-            for i in xrange(nobjs):
-                offset = self.entlen * i
-                ent = self.data[offset:offset+self.entlen]
-                f1 = nunpack(ent[:self.fl1], 1)
-                if f1 == 1 or f1 == 2:
+            decoded = min(nobjs, len(self.types))
+            for i in xrange(decoded):
+                if self.types[i]:
                     yield start+i
+            for i in xrange(decoded, nobjs):
+                yield start+i
         return
 
     def get_pos(self, objid):
-        index = 0
-        for (start, nobjs) in self.ranges:
-            if start <= objid and objid < start+nobjs:
-                index += objid - start
-                break
+        if self.starts is not None:
+            i = bisect_right(self.starts, objid)-1
+            if i < 0:
+                raise KeyError(objid)
+            (start, nobjs, index) = self.spans[i]
+            if start+nobjs <= objid:
+                raise KeyError(objid)
+            index += objid - start
+        else:
+            index = 0
+            for (start, nobjs) in self.ranges:
+                if start <= objid and objid < start+nobjs:
+                    index += objid - start
+                    break
+                else:
+                    index += nobjs
             else:
-                index += nobjs
+                raise KeyError(objid)
+        if index < len(self.types):
+            f1 = self.types[index]
+            f2 = self.fields2[index]
+            f3 = self.fields3[index]
         else:
-            raise KeyError(objid)
-        offset = self.entlen * index
-        ent = self.data[offset:offset+self.entlen]
-        f1 = nunpack(ent[:self.fl1], 1)
-        f2 = nunpack(ent[self.fl1:self.fl1+self.fl2])
-        f3 = nunpack(ent[self.fl1+self.fl2:])
+            (f1, f2, f3) = (1, 0, 0)
         if f1 == 1:
             return (None, f2, f3)
         elif f1 == 2:
@@ -269,6 +431,132 @@ class PDFXRefStream(PDFBaseXRef):
             raise KeyError(objid)
 
 
+##  Object caches
+##
+OBJ_BYTES = 64
+
+
+def obj_size(obj, depth=0):
+    """Rough count of the bytes held by a parsed object.
+
+    Strings and stream data count their length, every object a further
+    OBJ_BYTES. Containers nested deeper than 32 levels are not walked.
+    """
+    if isinstance(obj, PDFStream):
+        return OBJ_BYTES+len(obj.rawdata or '')+len(obj.data or '')+obj_size(obj.attrs, depth+1)
+    if isinstance(obj, str):
+        return OBJ_BYTES+len(obj)
+    if 32 < depth:
+        return OBJ_BYTES
+    if isinstance(obj, dict):
+        return OBJ_BYTES+sum(obj_size(v, depth+1) for v in obj.itervalues())
+    if isinstance(obj, (list, tuple)):
+        return OBJ_BYTES+sum(obj_size(v, depth+1) for v in obj)
+    return OBJ_BYTES
+
+
+class ObjCache(object):
+
+    """Keeps every object for the life of the document.
+
+    Entries are (obj, genno) under an objid, or the (objs, n) parsed
+    from an object stream under ('ObjStm', objid).
+    """
+
+    def __init__(self):
+        self.objs = {}
+        self.hits = self.misses = self.evictions = 0
+        return
+
+    def __len__(self):
+        return len(self.objs)
+
+    def get(self, key):
+        value = self.objs.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.objs[key] = value
+        return
+
+    def stats(self):
+        return {'entries': len(self), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class LRUObjCache(ObjCache):
+
+    """Evicts the least recently used objects past a budget of bytes.
+
+    Sizes are obj_size estimates. A stream grows when it is decoded,
+    after getobj has returned it, so the size of the last stream used
+    is measured again on the next get or put. An evicted object is
+    parsed and decoded again when it is next needed.
+    """
+
+    def __init__(self, budget):
+        ObjCache.__init__(self)
+        self.budget = budget
+        self.objs = OrderedDict()
+        self.sizes = {}
+        self.bytes = self.peak = 0
+        self.last = None
+        return
+
+    def resize(self, key):
+        if key not in self.objs:
+            return
+        size = obj_size(self.objs[key][0])
+        self.bytes += size-self.sizes[key]
+        self.sizes[key] = size
+        return
+
+    def trim(self):
+        self.peak = max(self.peak, self.bytes)
+        while self.budget < self.bytes and self.objs:
+            (key, _) = self.objs.popitem(last=False)
+            self.bytes -= self.sizes.pop(key)
+            self.evictions += 1
+        return
+
+    def touch(self, key, value):
+        if self.last is not None:
+            self.resize(self.last)
+            self.trim()
+        self.last = key if isinstance(value[0], PDFStream) else None
+        return
+
+    def get(self, key):
+        value = self.objs.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.objs[key] = value
+        self.touch(key, value)
+        return value
+
+    def put(self, key, value):
+        if key in self.objs:
+            del self.objs[key]
+            self.bytes -= self.sizes.pop(key)
+        self.objs[key] = value
+        self.sizes[key] = obj_size(value[0])
+        self.bytes += self.sizes[key]
+        self.touch(key, value)
+        self.trim()
+        return
+
+    def stats(self):
+        stats = ObjCache.stats(self)
+        stats.update({'bytes': self.bytes, 'peak': self.peak, 'budget': self.budget})
+        return stats
+
+
 ##  PDFDocument
 ##
 class PDFDocument(object):
@@ -283,12 +571,14 @@ class PDFDocument(object):
       doc = PDFDocument(parser, password)
       obj = doc.getobj(objid)
 
+    Parsed objects are kept in cache, an ObjCache unless another
+    policy such as LRUObjCache(budget) is passed in.
     """
 
     debug = 0
     PASSWORD_PADDING = '(\xbfN^Nu\x8aAd\x00NV\xff\xfa\x01\x08..\x00\xb6\xd0h>\x80/\x0c\xa9\xfedSiz'
 
-    def __init__(self, parser, password='', caching=True, fallback=True, dbg=False):
+    def __init__(self, parser, password='', caching=True, fallback=True, dbg=False, cache=None):
         if dbg:
             print 'PDFDocument() debugging enabled'
             debug = 3
@@ -303,8 +593,7 @@ class PDFDocument(object):
         self.encryption = None
         self.decipher = None
         self._parser = None
-        self._cached_objs = {}
-        self._parsed_objs = {}
+        self.cache = cache if cache is not None else ObjCache()
         self._parser = parser
         self._parser.set_document(self)
         self.is_printable = self.is_modifiable = self.is_extractable = True
@@ -407,12 +696,14 @@ class PDFDocument(object):
         return Arcfour(key).process(data)
 
     def _getobj_objstm(self, stream, index, objid):
-        if stream.objid in self._parsed_objs:
-            (objs, n) = self._parsed_objs[stream.objid]
+        key = ('ObjStm', stream.objid)
+        value = self.cache.get(key)
+        if value is not None:
+            (objs, n) = value
         else:
             (objs, n) = self._get_objects(stream)
             if self.caching:
-                self._parsed_objs[stream.objid] = (objs, n)
+                self.cache.put(key, (objs, n))
         i = n*2+index
         try:
             obj = objs[i]
@@ -430,7 +721,7 @@ class PDFDocument(object):
             if STRICT:
                 raise PDFSyntaxError('N is not defined: %r' % stream)
             n = 0
-        parser = PDFStreamParser(stream.get_data())
+        parser = PDFStreamParser(stream.get_data(), mapped=self._parser.data is not None)
         parser.set_document(self)
         objs = []
         try:
@@ -462,8 +753,9 @@ class PDFDocument(object):
             raise PDFException('PDFDocument is not initialized')
         if 2 <= self.debug:
             print >>sys.stderr, 'getobj: objid=%r' % (objid)
-        if objid in self._cached_objs:
-            (obj, genno) = self._cached_objs[objid]
+        value = self.cache.get(objid)
+        if value is not None:
+            (obj, genno) = value
         else:
             for xref in self.xrefs:
                 try:
@@ -486,7 +778,7 @@ class PDFDocument(object):
             if 2 <= self.debug:
                 print >>sys.stderr, 'register: objid=%r: %r' % (objid, obj)
             if self.caching:
-                self._cached_objs[objid] = (obj, genno)
+                self.cache.put(objid, (obj, genno))
         if self.decipher:
             obj = decipher_all(self.decipher, objid, genno, obj)
         return obj
@@ -614,3 +906,187 @@ class PDFDocument(object):
             pos = int_value(trailer['Prev'])
             self.read_xref_from(parser, pos, xrefs)
         return
+
+
+import unittest
+
+
+##  Simplistic Test cases
+##
+class TestPDFXRefFallback(unittest.TestCase):
+
+    # No xref table, a stream whose data holds lines that look like an object
+    # header and a trailer, and a last object cut short by the end of the file.
+    TRUNCATED = ('%PDF-1.4\n'
+                 '1 0 obj\n<< /Type /Catalog /Pages 2 0 R /OpenAction 3 0 R >>\nendobj\n'
+                 '2 0 obj\n<< /Type /Pages /Kids [] /Count 0 >>\nendobj\n'
+                 '3 0 obj\n<< /S /JavaScript /JS (app.alert\\(1\\);) >>\nendobj\n'
+                 '4 0 obj\n<< /Length 56 >>\nstream\n'
+                 'BT (x) Tj ET\n3 0 obj << /S /URI >>\nendobj\ntrailer\n<< >>\n'
+                 'endstream\nendobj\n'
+                 '5 0 obj\n<< /Type /Annot /Subtype /Link /Rect [0 0 10')
+
+    def get_doc(self, mapped):
+        from StringIO import StringIO
+        from pdfparser import PDFParser
+        return PDFDocument(PDFParser(StringIO(self.TRUNCATED), mapped=mapped))
+
+    def test_truncated(self):
+        for mapped in (False, True):
+            doc = self.get_doc(mapped)
+            self.assertEqual(len(doc.xrefs), 1)
+            xref = doc.xrefs[0]
+            self.assertTrue(isinstance(xref, PDFXRefFallback))
+            # Every header is found, the cut short object included, and no
+            # object is parsed to find them. The header and trailer inside the
+            # stream data are not taken for the objects of the file.
+            self.assertEqual(sorted(xref.get_objids()), [1, 2, 3, 4, 5])
+            for objid in xrange(1, 6):
+                self.assertEqual(xref.get_pos(objid), (None, self.TRUNCATED.index('%d 0 obj' % objid), 0))
+            self.assertEqual(xref.get_trailer(), {})
+            self.assertEqual(doc.getobj(1)['Type'], LIT('Catalog'))
+            self.assertEqual(doc.getobj(3)['S'], LIT('JavaScript'))
+            self.assertTrue(doc.getobj(4).get_data().startswith('BT (x) Tj ET\n3 0 obj'))
+            self.assertRaises(PDFObjectNotFound, doc.getobj, 5)
+        return
+
+    def test_unterminated_stream(self):
+        # Without an endstream every header after the stream keyword is stream data
+        data = self.TRUNCATED.replace('endstream', 'end')
+        from StringIO import StringIO
+        from pdfparser import PDFParser
+        doc = PDFDocument(PDFParser(StringIO(data)))
+        self.assertEqual(sorted(doc.xrefs[0].get_objids()), [1, 2, 3, 4])
+        return
+
+
+class TestXRefEntries(unittest.TestCase):
+
+    def get_parser(self, data):
+        from StringIO import StringIO
+        from pdfparser import PDFParser
+        return PDFParser(StringIO(data))
+
+    def get_stream(self, index, widths, entries, cut=0):
+        data = ''.join(entries)
+        if cut:
+            data = data[:-cut]
+        spec = ('%%PDF-1.5\n5 0 obj\n<< /Type /XRef /Size 20 /Index [%s] /W [%s] /Length %d >>\nstream\n'
+                % (' '.join(map(str, index)), ' '.join(map(str, widths)), len(data)))
+        # no EOL before endstream, the parser would keep it in the data
+        doc = PDFDocument(self.get_parser(spec+data+'endstream\nendobj\nstartxref\n9\n%%EOF\n'),
+                          fallback=False)
+        (xref,) = doc.xrefs
+        self.assertTrue(isinstance(xref, PDFXRefStream))
+        return xref
+
+    def test_unpack_columns(self):
+        data = '\x01\x00\x10\x02\x02\x00\x20\x03'
+        self.assertEqual(unpack_columns(data, (1, 2, 1), 2), [[1, 2], [16, 32], [2, 3]])
+        self.assertEqual(unpack_columns(data, (0, 4, 0), 2), [None, [0x01001002, 0x02002003], None])
+        # wider than 4 bytes, from 4 and 2 byte parts
+        self.assertEqual(unpack_columns('\x00\x00\x01\x00\x00\x02\x07', (6, 1), 1), [[0x1000002], [7]])
+        self.assertEqual(unpack_columns(data, (1, 2, 1), 0), [[], [], []])
+        return
+
+    def test_stream_ranges(self):
+        # two ranges given out of order, the type field left out (/W 0) reads as 1
+        entries = ['\x00\x10\x00', '\x00\x20\x01', '\x01\x00\x00', '\x01\x10\x00', '\x00\x30\x02']
+        xref = self.get_stream((10, 3, 2, 2), (0, 2, 1), entries)
+        self.assertEqual(sorted(xref.get_objids()), [2, 3, 10, 11, 12])
+        self.assertEqual(xref.get_pos(10), (None, 0x10, 0))
+        self.assertEqual(xref.get_pos(12), (None, 0x100, 0))
+        self.assertEqual(xref.get_pos(2), (None, 0x110, 0))
+        self.assertEqual(xref.get_pos(3), (None, 0x30, 2))
+        for objid in (0, 1, 4, 9, 13):
+            self.assertRaises(KeyError, xref.get_pos, objid)
+        return
+
+    def test_stream_types(self):
+        # a free entry, an object in an object stream, and an overlapping range
+        entries = ['\x00\x00\x00', '\x02\x07\x01', '\x01\x40\x00', '\x01\x50\x00']
+        xref = self.get_stream((0, 3, 1, 1), (1, 1, 1), entries)
+        self.assertEqual(xref.starts, None)
+        self.assertRaises(KeyError, xref.get_pos, 0)
+        self.assertEqual(xref.get_pos(1), (7, 1, 0))
+        self.assertEqual(xref.get_pos(2), (None, 0x40, 0))
+        return
+
+    def test_stream_truncated(self):
+        # the last entry is cut short and the one after it is gone
+        entries = ['\x01\x00\x10\x00', '\x01\x00\x20\x00', '\x01\x00\x30\x00']
+        xref = self.get_stream((0, 4), (1, 2, 1), entries, cut=2)
+        self.assertEqual(xref.get_pos(1), (None, 0x20, 0))
+        self.assertEqual(xref.get_pos(2), (None, 0, 0))
+        self.assertEqual(xref.get_pos(3), (None, 0, 0))
+        self.assertRaises(KeyError, xref.get_pos, 4)
+        return
+
+    def test_table_entries(self):
+        data = ('0 2\n0000000000 65535 f\r\n0000000017 00000 n\r\n'
+                '7 2\n0000000081 00002 n \n0000000000 00000 f \n'
+                # not 20 bytes an entry, read line by line
+                '9 1\n100 0 n\n'
+                'trailer\n<< /Size 10 >>\n')
+        xref = PDFXRef()
+        xref.load(self.get_parser(data))
+        self.assertEqual(sorted(xref.get_objids()), [1, 7, 9])
+        self.assertEqual(xref.get_pos(1), (None, 17, 0))
+        self.assertEqual(xref.get_pos(7), (None, 81, 2))
+        self.assertEqual(xref.get_pos(9), (None, 100, 0))
+        self.assertEqual(xref.get_trailer(), {'Size': 10})
+        return
+
+
+class TestObjCache(unittest.TestCase):
+
+    DOC = ('%PDF-1.4\n'
+           '1 0 obj\n<< /Type /Catalog >>\nendobj\n'
+           '2 0 obj\n<< /Length 12 >>\nstream\nBT (x) Tj ETendstream\nendobj\n'
+           '3 0 obj\n[1 2 3]\nendobj\n')
+
+    def test_counters(self):
+        cache = ObjCache()
+        self.assertEqual(cache.get(1), None)
+        cache.put(1, (LIT('a'), 0))
+        self.assertEqual(cache.get(1), (LIT('a'), 0))
+        self.assertEqual(cache.stats(), {'entries': 1, 'hits': 1, 'misses': 1, 'evictions': 0})
+        return
+
+    def test_lru_eviction(self):
+        # room for three objects of OBJ_BYTES each
+        cache = LRUObjCache(3*OBJ_BYTES)
+        for objid in (1, 2, 3):
+            cache.put(objid, (objid, 0))
+        self.assertEqual(cache.get(1), (1, 0))
+        cache.put(4, (4, 0))
+        # 2 was used least recently
+        self.assertEqual(list(cache.objs), [3, 1, 4])
+        self.assertEqual(cache.get(2), None)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 1, 1))
+        self.assertEqual((stats['bytes'], stats['peak']), (3*OBJ_BYTES, 4*OBJ_BYTES))
+        return
+
+    def test_decode_after_eviction(self):
+        from StringIO import StringIO
+        from pdfparser import PDFParser
+        cache = LRUObjCache(4*OBJ_BYTES)
+        doc = PDFDocument(PDFParser(StringIO(self.DOC)), cache=cache)
+        stream = doc.getobj(2)
+        self.assertEqual(stream.get_data(), 'BT (x) Tj ET')
+        self.assertTrue(doc.getobj(2) is stream)
+        # the decoded stream is measured again and pushed out by the next object
+        doc.getobj(3)
+        self.assertTrue(2 not in cache.objs)
+        again = doc.getobj(2)
+        self.assertTrue(again is not stream)
+        self.assertEqual(again.get_data(), 'BT (x) Tj ET')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+        self.assertTrue(1 <= stats['evictions'])
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,7 +30,7 @@ class PDFParser(PSStackParser):
     It also reads XRefs at the end of every PDF file.
 
     Typical usage:
-      parser = PDFParser(fp)
+      parser = PDFParser(fp)  # or PDFParser(fp, mapped=True)
       parser.read_xref()
       parser.read_xref(fallback=True) # optional
       parser.set_document(doc)
@@ -39,8 +39,8 @@ class PDFParser(PSStackParser):
 
     """
 
-    def __init__(self, fp, dbg=False):
-        PSStackParser.__init__(self, fp, dbg)
+    def __init__(self, fp, dbg=False, mapped=False):
+        PSStackParser.__init__(self, fp, dbg, mapped)
         self.doc = None
         self.fallback = False
         return
@@ -99,8 +99,7 @@ class PDFParser(PSStackParser):
                     raise PDFSyntaxError('Unexpected EOF')
                 return
             pos += len(line)
-            self.fp.seek(pos)
-            data = self.fp.read(objlen)
+            data = self.read_n_from(pos, objlen)
             self.seek(pos+objlen)
             while 1:
                 try:
@@ -143,8 +142,8 @@ class PDFStreamParser(PDFParser):
     indirect references to other objects in the same document.
     """
 
-    def __init__(self, data):
-        PDFParser.__init__(self, StringIO(data))
+    def __init__(self, data, mapped=False):
+        PDFParser.__init__(self, StringIO(data), mapped=mapped)
         return
 
     def flush(self):
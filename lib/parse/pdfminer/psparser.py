@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import sys
 import re
+import mmap
 from utils import choplist
 
 STRICT = 0
@@ -150,21 +151,171 @@ END_KEYWORD = re.compile(r'[#/%\[\]()<>{}\s]')
 END_STRING = re.compile(r'[()\134]')
 OCT_STRING = re.compile(r'[0-7]')
 ESC_STRING = {'b': 8, 't': 9, 'n': 10, 'f': 12, 'r': 13, '(': 40, ')': 41, '\\': 92}
+OCT_ESC = re.compile(r'[0-7]{1,3}')
+LITERAL_HEX = re.compile(r'#([0-9a-fA-F]{0,2})')
+
+# One alternative per token type of the PSBaseParser state machine, tried at
+# each position. A token that needs a delimiter after it only matches when the
+# delimiter is there, so a token cut off by the end of the buffer does not
+# match at all, just as the state machine hits EOF on it. The literal body is
+# made atomic with (?=(...))\1 so it can not back off to a '#' and end early.
+# Group 1 is the whitespace skipped before the token.
+TOKEN = re.compile(r'''
+  (\s*)(?:
+    (?P<comment>%[^\r\n]*)
+  | /(?=(?P<literal>(?:[^#/%\[\]()<>{}\s]|\#[0-9a-fA-F]{0,2})*))(?P=literal)(?=[/%\[\]()<>{}\s])
+  | (?P<int>[-+0-9][0-9]*)(?=[^0-9.])
+  | (?P<float>(?:[-+0-9][0-9]*)?\.[0-9]*)(?=[^0-9])
+  | (?P<keyword>[A-Za-z][^#/%\[\]()<>{}\s]*)(?=[#/%\[\]()<>{}\s])
+  | \((?P<string>[^()\\]*)\)
+  | (?P<dict_begin><<)
+  | <(?P<hexstring>[\s0-9a-fA-F]*)(?=[^\s0-9a-fA-F])
+  | (?P<dict_end>>>)
+  | (?P<wclose>>)(?=.)
+  | (?P<paren>\()
+  | (?P<char>[^-+0-9./A-Za-z(<>%\s])
+  )''', re.VERBOSE | re.DOTALL)
+
+
+def scan_string(s, i):
+    """Scans a string with escapes or nested parens, from just past its '('.
+
+    Returns (string, end) or None if the buffer ends first.
+    """
+    parts = []
+    paren = 1
+    while 1:
+        m = END_STRING.search(s, i)
+        if not m:
+            return None
+        j = m.start(0)
+        parts.append(s[i:j])
+        c = s[j]
+        i = j+1
+        if c == '\\':
+            m = OCT_ESC.match(s, i)
+            if m:
+                i = m.end(0)
+                if i == len(s):
+                    # the state machine needs the next char to end the escape
+                    return None
+                parts.append(chr(int(m.group(0), 8)))
+            elif i < len(s):
+                if s[i] in ESC_STRING:
+                    parts.append(chr(ESC_STRING[s[i]]))
+                i += 1
+            continue
+        if c == '(':
+            paren += 1
+        else:
+            paren -= 1
+            if not paren:
+                return (''.join(parts), i)
+        parts.append(c)
+
+
+def scan_token(s, i):
+    """Finds the next token of s from position i with the TOKEN regex.
+
+    Returns (pos, token, end), or None at the end of s. The tokens
+    and positions are the same as PSBaseParser.nexttoken gives.
+    """
+    while 1:
+        m = TOKEN.match(s, i)
+        if not m:
+            return None
+        i = m.end(0)
+        kind = m.lastgroup
+        if kind == 'keyword':
+            name = m.group(kind)
+            if name == 'true':
+                token = True
+            elif name == 'false':
+                token = False
+            else:
+                token = KWD(name)
+        elif kind == 'literal':
+            name = m.group(kind)
+            if '#' in name:
+                name = LITERAL_HEX.sub(lambda h: chr(int(h.group(1), 16)) if h.group(1) else '', name)
+            token = LIT(name)
+        elif kind == 'int':
+            try:
+                token = int(m.group(kind))
+            except ValueError:
+                continue
+        elif kind == 'float':
+            try:
+                token = float(m.group(kind))
+            except ValueError:
+                continue
+        elif kind == 'string':
+            token = m.group(kind)
+        elif kind == 'paren':
+            r = scan_string(s, i)
+            if r is None:
+                return None
+            (token, i) = r
+        elif kind == 'hexstring':
+            token = HEX_PAIR.sub(lambda h: chr(int(h.group(0), 16)),
+                                 SPC.sub('', m.group(kind)))
+        elif kind == 'dict_begin':
+            token = KEYWORD_DICT_BEGIN
+        elif kind == 'dict_end':
+            token = KEYWORD_DICT_END
+        elif kind == 'char':
+            token = KWD(m.group(kind))
+        else:
+            # a comment or a '>' on its own
+            continue
+        return (m.end(1), token, i)
+
+
+def iter_tokens(s, pos=0):
+    """Yields (pos, token) for every token of s in one pass."""
+    while 1:
+        r = scan_token(s, pos)
+        if r is None:
+            return
+        (tokenpos, token, pos) = r
+        yield (tokenpos, token)
+
+
+def map_input(fp):
+    """Returns the whole input of fp as one read-only buffer.
+
+    This is an mmap of the file when fp has one, otherwise
+    (StringIO, pipes, empty files) its contents read into memory.
+    """
+    try:
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        fp.seek(0)
+        return fp.read()
 
 
 class PSBaseParser(object):
 
     """Most basic PostScript parser that performs only tokenization.
+
+    With mapped=True the whole input is one buffer (see map_input)
+    and offsets into it are file positions, so seek() and the
+    read_* methods cost no system calls or buffer refills, and
+    nexttoken() uses scan_token instead of the _parse_* states.
     """
     BUFSIZ = 4096
     BYTES = 0
     debug = 0
 
-    def __init__(self, fp, dbg=False):
+    def __init__(self, fp, dbg=False, mapped=False):
         if dbg:
             print 'PSBaseParser() debugging enabled'
             self.debug = 3
         self.fp = fp
+        self.data = None
+        if mapped:
+            self.data = map_input(fp)
+            self.BYTES = len(self.data)
         self.seek(0)
         return
 
@@ -176,18 +327,17 @@ class PSBaseParser(object):
 
     def close(self):
         self.flush()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
         return
 
     def tell(self):
         return self.bufpos+self.charpos
 
     def poll(self, pos=None, n=80):
-        pos0 = self.fp.tell()
         if not pos:
             pos = self.bufpos+self.charpos
-        self.fp.seek(pos)
-        print >>sys.stderr, 'poll(%d): %r' % (pos, self.fp.read(n))
-        self.fp.seek(pos0)
+        print >>sys.stderr, 'poll(%d): %r' % (pos, self.read_n_from(pos, n))
         return
 
     def seek(self, pos):
@@ -195,11 +345,16 @@ class PSBaseParser(object):
         """
         if 2 <= self.debug:
             print >>sys.stderr, 'seek: %r' % pos
-        self.fp.seek(pos)
         # reset the status for nextline()
-        self.bufpos = pos
-        self.buf = ''
-        self.charpos = 0
+        if self.data is not None:
+            self.bufpos = 0
+            self.buf = self.data
+            self.charpos = pos
+        else:
+            self.fp.seek(pos)
+            self.bufpos = pos
+            self.buf = ''
+            self.charpos = 0
         # reset the status for nexttoken()
         self._parse1 = self._parse_main
         self._curtoken = ''
@@ -210,6 +365,8 @@ class PSBaseParser(object):
     def fillbuf(self):
         if self.charpos < len(self.buf):
             return
+        if self.data is not None:
+            raise PSEOF('Unexpected EOF')
         # fetch next chunk.
         self.bufpos = self.fp.tell()
         self.buf = self.fp.read(self.BUFSIZ)
@@ -255,14 +412,16 @@ class PSBaseParser(object):
 
         This is used to locate the trailers at the end of a file.
         """
-        self.fp.seek(0, 2)
-        pos = self.fp.tell()
+        if self.data is not None:
+            pos = len(self.data)
+        else:
+            self.fp.seek(0, 2)
+            pos = self.fp.tell()
         buf = ''
         while 0 < pos:
             prevpos = pos
             pos = max(0, pos-self.BUFSIZ)
-            self.fp.seek(pos)
-            s = self.fp.read(prevpos-pos)
+            s = self.read_n_from(pos, prevpos-pos)
             if not s:
                 break
             while 1:
@@ -276,6 +435,8 @@ class PSBaseParser(object):
         return
 
     def read_n_from(self, pos, nbytes):
+        if self.data is not None:
+            return self.data[pos:pos+nbytes]
         oldpos = self.fp.tell()
         self.fp.seek(pos, 0)
         buff = self.fp.read(nbytes)
@@ -283,6 +444,8 @@ class PSBaseParser(object):
         return buff
 
     def read_from_end(self, nbytes):
+        if self.data is not None:
+            return self.data[max(0, len(self.data)-nbytes):]
         self.fp.seek(-nbytes, 2)
         buff = self.fp.read()
         self.fp.seek(0)
@@ -495,10 +658,18 @@ class PSBaseParser(object):
         return j
 
     def nexttoken(self):
-        while not self._tokens:
-            self.fillbuf()
-            self.charpos = self._parse1(self.buf, self.charpos)
-        token = self._tokens.pop(0)
+        if self.data is not None:
+            r = scan_token(self.data, self.charpos)
+            if r is None:
+                self.charpos = len(self.data)
+                raise PSEOF('Unexpected EOF')
+            (pos, obj, self.charpos) = r
+            token = (pos, obj)
+        else:
+            while not self._tokens:
+                self.fillbuf()
+                self.charpos = self._parse1(self.buf, self.charpos)
+            token = self._tokens.pop(0)
         if 2 <= self.debug:
             #print >>sys.stderr, 'nexttoken: %r' % ([(a,a[:8]) for a in token])
             print >>sys.stderr, 'nexttoken: (%s, %10s)' % token
@@ -509,8 +680,8 @@ class PSBaseParser(object):
 ##
 class PSStackParser(PSBaseParser):
 
-    def __init__(self, fp, dbg=False):
-        PSBaseParser.__init__(self, fp, dbg)
+    def __init__(self, fp, dbg=False, mapped=False):
+        PSBaseParser.__init__(self, fp, dbg, mapped)
         self.reset()
         return
 
@@ -687,13 +858,13 @@ func/a/b{(c)do*}def
       (258, {'foo': 'bar'}),
     ]
 
-    def get_tokens(self, s):
+    def get_tokens(self, s, mapped=False):
         import StringIO
 
         class MyParser(PSBaseParser):
             def flush(self):
                 self.add_results(*self.popall())
-        parser = MyParser(StringIO.StringIO(s))
+        parser = MyParser(StringIO.StringIO(s), mapped=mapped)
         r = []
         try:
             while 1:
@@ -702,13 +873,13 @@ func/a/b{(c)do*}def
             pass
         return r
 
-    def get_objects(self, s):
+    def get_objects(self, s, fp=None, mapped=False):
         import StringIO
 
         class MyParser(PSStackParser):
             def flush(self):
                 self.add_results(*self.popall())
-        parser = MyParser(StringIO.StringIO(s))
+        parser = MyParser(fp or StringIO.StringIO(s), mapped=mapped)
         r = []
         try:
             while 1:
@@ -729,5 +900,59 @@ func/a/b{(c)do*}def
         self.assertEqual(objs, self.OBJS)
         return
 
+    def test_3(self):
+        import tempfile
+        self.assertEqual(self.get_tokens(self.TESTDATA, mapped=True), self.TOKENS)
+        self.assertEqual(self.get_objects(self.TESTDATA, mapped=True), self.OBJS)
+        with tempfile.TemporaryFile() as fp:
+            fp.write(self.TESTDATA)
+            fp.flush()
+            self.assertEqual(self.get_objects(self.TESTDATA, fp, mapped=True), self.OBJS)
+        return
+
+    def test_4(self):
+        self.assertEqual(list(iter_tokens(self.TESTDATA)), self.TOKENS)
+        # cut off anywhere, scan_token stops where the state machine hits EOF
+        for n in xrange(len(self.TESTDATA)):
+            s = self.TESTDATA[:n]
+            self.assertEqual(self.get_tokens(s, mapped=True), self.get_tokens(s))
+        return
+
+
+def benchmark(paths, repeat=3):
+    """Tokens per second of the _parse_* state machine and of scan_token."""
+    import time
+    from cStringIO import StringIO
+    inputs = [(path, open(path, 'rb').read()) for path in paths]
+    if not inputs:
+        inputs = [('TESTDATA x 2000', TestPSBaseParser.TESTDATA * 2000)]
+    print '%-32s %10s %14s %14s %8s' % ('input', 'tokens', 'states tok/s', 'regex tok/s', 'match')
+    for (name, data) in inputs:
+        counts = []
+        rates = []
+        for mapped in (False, True):
+            best = None
+            for _ in xrange(repeat):
+                parser = PSBaseParser(StringIO(data), mapped=mapped)
+                count = 0
+                t0 = time.time()
+                try:
+                    while 1:
+                        parser.nexttoken()
+                        count += 1
+                except (PSException, ValueError):
+                    pass
+                elapsed = time.time() - t0
+                if best is None or elapsed < best:
+                    best = elapsed
+            counts.append(count)
+            rates.append(count / max(best, 1e-9))
+        print '%-32s %10d %14.0f %14.0f %8s' % (name[-32:], counts[1], rates[0], rates[1], counts[0] == counts[1])
+    return
+
 if __name__ == '__main__':
-    unittest.main()
+    # python psparser.py benchmark [file ...]
+    if sys.argv[1:2] == ['benchmark']:
+        benchmark(sys.argv[2:])
+    else:
+        unittest.main()
@@ -1,25 +1,40 @@
-import hashlib
+import itertools
 import logging
 import math
 import os
+import signal
 import sys
+import threading
 import time
+import zlib
 from argparse import ArgumentParser
-from multiprocessing import pool, Pool, cpu_count, Process, Lock, current_process
+from multiprocessing import pool, Pool, cpu_count, Lock
+from xml.etree.ElementTree import fromstring
 
 from storage import dbgw
+from storage.featurestore import FeatureStore
+from storage.index import FamilyIndex
+from process import cache
+from process.cache import get_hash
 from process.parsers import parse
+from process.pdf import PDF
+from process.scoring import FamilyMatrix, iter_blocks, score_block, share_blocks
+from process.serve import Scorer, get_server, stop_on_signal
 
-import networkx as nx
-import scipy.stats as stats
-from scipy.spatial.distance import canberra
-from scipy.cluster.hierarchy import *
 
-import matplotlib.pyplot as plt
+lock = Lock()
+PARSE_FUNC = None
+TIMEOUT = 0
+TIMED_OUT = False
+ARCHIVE = False
+REFEATURE_PAGE = 1000
 
 
-NUMFEATURES = 7
-lock = Lock()
+class ParseTimeout(BaseException):
+    """ Raised by the SIGALRM handler, a BaseException so the parsers' except Exception
+    handlers let it through and the parse stops
+    """
+    pass
 
 
 def plock(msg):
@@ -28,12 +43,6 @@ def plock(msg):
         sys.stdout.flush()
 
 
-def get_hash(data):
-    md5 = hashlib.md5()
-    md5.update(data)
-    return md5.hexdigest()
-
-
 def parse_file_set(fpath):
     try:
         fin = open(fpath, "r")
@@ -46,31 +55,101 @@ def parse_file_set(fpath):
         return set([line.rstrip('\n') for line in lines if not line.startswith('#')])
 
 
+def on_alarm(signum, frame):
+    global TIMED_OUT
+    TIMED_OUT = True
+    raise ParseTimeout()
+
+
+def init_parse_job(parse_func, timeout, archive=False):
+    global PARSE_FUNC, TIMEOUT, ARCHIVE
+    PARSE_FUNC = parse_func
+    TIMEOUT = timeout
+    ARCHIVE = archive
+    signal.signal(signal.SIGALRM, on_alarm)
+
+
+def parse_job(path):
+    """ Parse one sample in a pool worker, giving up after TIMEOUT seconds
+
+    :return: (path, job status, pdf or None)
+    :rtype: tuple
+    """
+    global TIMED_OUT
+    TIMED_OUT = False
+    pdf = None
+    signal.alarm(TIMEOUT)
+    try:
+        pdf = PARSE_FUNC(path)
+    except ParseTimeout:
+        pass
+    finally:
+        signal.alarm(0)
+    if TIMED_OUT:
+        return path, dbgw.JobDb.TIMEOUT, None
+    if pdf is None or not pdf.parsed or not pdf.ftr_vec:
+        return path, dbgw.JobDb.FAILED, None
+    if ARCHIVE:
+        # The path is kept in the pdf's own row, so that samples with the same objects
+        # share one tree. Compress here, in the worker, and send the parent bytes
+        # instead of the element tree
+        pdf.xml.attrib.pop('path', None)
+        pdf.tree = dbgw.XmlDb.pack(pdf.get_xml_str())
+        pdf.xml = None
+    return path, dbgw.JobDb.COMPLETE, pdf
+
+
+def refeature_job(row):
+    """ Rebuild the graph and features of one archived xml tree in a pool worker
+
+    :return: (tree_md5, pdf or None)
+    :rtype: tuple
+    """
+    tree_md5, blob = row
+    pdf = PDF(tree_md5, tree_md5)
+    try:
+        pdf.xml = fromstring(zlib.decompress(blob))
+        pdf.set_feature_vector()
+    except Exception as e:
+        logging.error("main.refeature_job error on tree %s: %s" % (tree_md5, e))
+        return tree_md5, None
+    pdf.xml = None
+    return tree_md5, pdf
+
+
+class Window(object):
+    """ Bounds how many tasks a pool holds that the consumer has not finished with
+
+    feed() blocks the pool's task handler once size tasks are out, and done() lets
+    one more in, so a slow consumer holds back parsing instead of letting finished
+    results pile up in the pool's result queue.
+    """
+
+    def __init__(self, size):
+        self.slots = threading.Semaphore(size)
+        self.closed = False
+
+    def feed(self, items):
+        for item in items:
+            self.slots.acquire()
+            if self.closed:
+                return
+            yield item
+
+    def done(self):
+        self.slots.release()
+
+    def close(self):
+        self.closed = True
+        self.slots.release()
+
+
 def shutdown(pool_, job_db):
     pool_.close()
     pool_.join()
     job_db.close()
 
 
-def pscore(pdf_name, thresh, ftrs, gdb_path, unique_graphs):
-    pid = current_process().pid
-    graph_db = dbgw.GraphDb(gdb_path)
-    if not graph_db.init(graph_db.table, graph_db.cols):
-        logging.error("pscore %d could not initialize db. exiting." % pid)
-        sys.exit(-1)
-
-    for edge_md5 in unique_graphs:
-        pdf_id, ftrs_b = graph_db.load_family_features(edge_md5)
-        logging.debug("\t%s: %s" % (pdf_id, ftrs_b))
-        try:
-            can_dist = canberra(ftrs, ftrs_b)
-        except ValueError:
-            logging.error("pscore canberra calc error. likely bad features for %s or %s" % (pdf_name, pdf_id))
-        else:
-            if not thresh or can_dist <= thresh:
-                plock("%s,%s,%s,%f\n" % (pdf_name, edge_md5, pdf_id, can_dist))
-
-
 def save_score(pnum):
     global FILES, SIMSCORES
     FILES[pnum].write('\n'.join(SIMSCORES[pnum]))
@@ -83,173 +162,310 @@ def calc_workload(num_jobs, num_procs):
     return chunk_size, num_procs
 
 
-def calc_similarities(pdf, graph_db, num_procs, thresh):
-    unique_graphs = [row[0] for row in graph_db.get_unique('e_md5')]
-    unique_num = len(unique_graphs)
-    chunk_size, num_procs = calc_workload(unique_num, num_procs)
-    offsets = [x for x in range(0, unique_num, chunk_size)]
-    logging.debug("calc_sim: %d procs offsets[%d] unique_graphs[%d]" % (num_procs, len(offsets), unique_num))
+def calc_similarities(pdf, families, thresh):
+    if families.valid(pdf.ftr_vec) is None:
+        logging.error("calc_similarities canberra calc error. likely bad features for %s" % pdf.name)
+        return
+
+    plock("subject,family,candidate,score\n")
+    for edge_md5, pdf_id, can_dist in families.scores(pdf.ftr_vec, thresh):
+        plock("%s,%s,%s,%f\n" % (pdf.name, edge_md5, pdf_id, can_dist))
+
 
-    procs = [Process(target=pscore, args=(pdf.name, thresh, pdf.ftr_vec, graph_db.dbpath, unique_graphs[offsets[proc]:offsets[proc]+chunk_size])) for proc in range(num_procs)]
+def query_index(pdf, family_index, thresh, knn):
+    if not family_index.valid(pdf.ftr_vec):
+        logging.error("query_index skipping %s, likely bad features" % pdf.name)
+        return
 
-    logging.debug("nabu.calc_simil. starting  children")
+    if knn:
+        found = family_index.knn(pdf.ftr_vec, knn, thresh or float('inf'))
+    else:
+        found = family_index.range(pdf.ftr_vec, thresh)
 
     plock("subject,family,candidate,score\n")
-    for proc in procs:
-        proc.start()
+    for can_dist, (edge_md5, pdf_id) in found:
+        plock("%s,%s,%s,%f\n" % (pdf.name, edge_md5, pdf_id, can_dist))
 
-    logging.debug("nabu.calc_simil. waiting on children")
-    for proc in procs:
-        proc.join()
 
+def batch_score_pdfs(argv, graph_db, parse_func):
+    todo = []
+    for pdf_id in parse_file_set(argv.fin):
+        if os.path.isfile(pdf_id):
+            todo.append(pdf_id)
+        else:
+            logging.warning("main.batch_score_pdfs not a file: %s" % pdf_id)
 
-def score_pdfs(argv, job_db, graph_db):
-    todo = parse_file_set(argv.fin)
+    subjects = FamilyMatrix()
+    p = Pool(argv.procs, maxtasksperchild=argv.chunk)
+    with graph_db.batch(argv.flush_rows, argv.flush_secs):
+        try:
+            hashes, cached, repeats = cache.resolve(graph_db, todo, cache.hash_files(todo, argv.procs))
+            logging.info("main.batch_score_pdfs %d cached, %d repeated samples" % (len(cached), len(repeats)))
+            for path, pdf_id in cached:
+                pdf = cache.copy_cached(graph_db, path, pdf_id)
+                if pdf:
+                    subjects.add(pdf.name, pdf.name, pdf.ftr_vec)
+
+            parsed = {}
+            to_parse = [path for path in todo if path in hashes]
+            for cnt, pdf in enumerate(p.imap_unordered(parse_func, to_parse, argv.chunk), 1):
+                sys.stderr.write("Parsed: %7d/%7d\r" % (cnt, len(to_parse)))
+                if pdf.ftr_vec:
+                    graph_db.save(pdf.name, get_hash(str(pdf.v)), get_hash(str(pdf.e)), pdf.v, pdf.e, pdf.ftr_vec)
+                    if hashes[pdf.path]:
+                        graph_db.save_content(hashes[pdf.path], pdf.name)
+                    subjects.add(pdf.name, pdf.name, pdf.ftr_vec)
+                    parsed[pdf.path] = pdf
+
+            for path, first in repeats:
+                if first in parsed:
+                    name = os.path.basename(path)
+                    graph_db.copy_pdf(parsed[first].name, name)
+                    subjects.add(name, name, parsed[first].ftr_vec)
+        except KeyboardInterrupt:
+            logging.warning("\nTerminating pool...\n")
+            p.terminate()
+            p.join()
+            return
+    p.close()
+    p.join()
+
+    store = FeatureStore.for_db(graph_db)
+    store.sync(graph_db, argv.reindex)
+    families = FamilyMatrix()
+    families.map(store)
+    logging.info("main.batch_score_pdfs scoring %d subjects against %d families" % (len(subjects), len(families)))
+
+    p = Pool(argv.procs, initializer=share_blocks, initargs=(subjects, families, argv.thresh))
+    plock("subject,family,candidate,score\n")
+    try:
+        for lines in p.imap_unordered(score_block, iter_blocks(len(subjects), len(families))):
+            plock(''.join(lines))
+    except KeyboardInterrupt:
+        logging.warning("\nTerminating pool...\n")
+        p.terminate()
+    p.close()
+    p.join()
 
-    parse_func = parse.get_parser(argv.parser)
+
+def score_pdfs(argv, job_db, graph_db):
+    parse_func = parse.get_parser(argv.parser, graph_only=True, cache_bytes=argv.cache_mb << 20,
+                                  mapped=argv.mapped)
     if not parse_func:
         logging.error("main.score_pdfs did not find valid parser: %s" % argv.parser)
         sys.exit(1)
 
+    if argv.batch:
+        if argv.knn:
+            logging.error("main.score_pdfs --knn is not supported with --batch")
+            sys.exit(1)
+        return batch_score_pdfs(argv, graph_db, parse_func)
+
+    todo = parse_file_set(argv.fin)
+
+    family_index = None
+    store = FeatureStore.for_db(graph_db)
+    families = FamilyMatrix()
+    if argv.thresh or argv.knn:
+        family_index = FamilyIndex.for_db(graph_db)
+        family_index.load()
+        family_index.sync(graph_db, argv.reindex)
+    else:
+        store.sync(graph_db, argv.reindex)
+        families.map(store)
+
     for pdf_id in todo:
         sys.stdout.write("Scoring: %s\n" % pdf_id)
         if not os.path.isfile(pdf_id):
             logging.warning("main.score_pdfs not a file: %s" % pdf_id)
             continue
 
-        pdf = parse_func(pdf_id)
+        content_md5 = cache.hash_file(pdf_id)
+        pdf = cache.load_cached(graph_db, pdf_id, content_md5)
+        if pdf:
+            e_md5 = get_hash(str(pdf.e))
+        else:
+            pdf = parse_func(pdf_id)
+            e_md5 = get_hash(str(pdf.e))
+            graph_db.save(pdf.name, get_hash(str(pdf.v)), e_md5, pdf.v, pdf.e, pdf.ftr_vec)
+            if content_md5 and pdf.ftr_vec:
+                graph_db.save_content(content_md5, pdf.name)
         logging.debug("%s: %s" % (pdf.name, pdf.ftr_vec))
 
-        graph_db.save(pdf.name, get_hash(str(pdf.v)), get_hash(str(pdf.e)), pdf.v, pdf.e, pdf.ftr_vec)
-        calc_similarities(pdf, graph_db, argv.procs, argv.thresh)
-
-
-def get_node_features(graph, node):
-    """  Node features based on NetSimile paper
-    :param node:
-    :type node:
-    :return:
-    :rtype:
-    """
-    """
-    degree of node
-    cluserting coef of node
-    avg number of node's two-hop away neighbors
-    avg clustering coef of Neighbors(node)
-    number of edges in node i's egonet
-    number of outgoing edges from ego(node)
-    number of neighbors(ego(node))
-    """
-    neighbors = graph.neighbors(node)
+        if family_index:
+            family_index.insert(e_md5, pdf.name, pdf.ftr_vec)
+            query_index(pdf, family_index, argv.thresh, argv.knn)
+        else:
+            families.add(e_md5, pdf.name, pdf.ftr_vec)
+            store.add(e_md5, pdf.name, pdf.ftr_vec)
+            calc_similarities(pdf, families, argv.thresh)
 
-    degree = graph.degree(node)
+    if family_index:
+        family_index.save()
+    store.flush()
 
-    cl_coef = nx.clustering(graph, node)
 
-    nbrs_two_hops = 0.0
-    nbrs_cl_coef = 0.0
-    for neighbor in neighbors:
-        nbrs_two_hops += graph.degree(neighbor)
-        nbrs_cl_coef += nx.clustering(graph, neighbor)
+def build_graphdb(argv, job_db, graph_db, xml_db=None):
 
-    try:
-        avg_two_hops = nbrs_two_hops / degree
-        avg_cl_coef = nbrs_cl_coef / degree
-    except ZeroDivisionError:
-        avg_two_hops = 0.0
-        avg_cl_coef = 0.0
+    todo = argv.todo
+    if not argv.update:
+        if argv.retry:
+            skip = (job_db.COMPLETE,)
+        else:
+            skip = (job_db.COMPLETE, job_db.FAILED, job_db.TIMEOUT)
+        todo = list(job_db.filter_done(argv.job_id, argv.todo, skip))
 
-    egonet = nx.ego_graph(graph, node)
+    cnt = 0
+    total_jobs = len(todo)
 
-    ego_size = egonet.size()
+    family_index = FamilyIndex.for_db(graph_db)
+    family_index.load()
+    store = FeatureStore.for_db(graph_db)
+    store.load()
 
-    ego_out = 0
-    ego_nbrs = set()
-    for ego_node in egonet:
-        for nbr in graph.neighbors(ego_node):
-            if nbr not in neighbors:
-                ego_out += 1
-                ego_nbrs.add(nbr)
+    pfunc = parse.get_parser(argv.parser, graph_only=xml_db is None, cache_bytes=argv.cache_mb << 20,
+                             mapped=argv.mapped)
+    if not pfunc:
+        logging.error("main.build_graphdb could not find parser: %s" % argv.parser)
+        sys.exit(1)
 
-    return [degree, cl_coef, avg_two_hops, avg_cl_coef, ego_size, ego_out, len(ego_nbrs)]
+    if not job_db.attach(graph_db):
+        logging.error("main.build_graphdb could not attach job db to graph db")
+        sys.exit(1)
 
+    p = Pool(argv.procs, init_parse_job, (pfunc, argv.timeout, xml_db is not None), maxtasksperchild=argv.chunk)
+    chunk = argv.chunk * argv.procs
+    window = Window((argv.procs + 1) * chunk)
+    if xml_db:
+        xml_db.batch(argv.flush_rows, argv.flush_secs, argv.write_queue)
 
-def get_graph_features(v, e):
-    """ Graph features based on NetSimile paper
+    with graph_db.batch(argv.flush_rows, argv.flush_secs, argv.write_queue) as writer:
+        try:
+            hashes, cached, repeats = cache.resolve(graph_db, todo, cache.hash_files(todo, argv.procs))
+            logging.info("main.build_graphdb %d cached, %d repeated samples" % (len(cached), len(repeats)))
+            for path, pdf_id in cached:
+                cnt += 1
+                graph_db.copy_pdf(pdf_id, os.path.basename(path))
+                if xml_db:
+                    xml_db.copy(pdf_id, os.path.basename(path))
+                job_db.mark(argv.job_id, path, job_db.COMPLETE)
+
+            statuses = {}
+            to_parse = [path for path in todo if path in hashes]
+            for path, status, pdf in p.imap_unordered(parse_job, window.feed(to_parse), chunk):
+                cnt += 1
+                if argv.write_queue:
+                    sys.stdout.write("%7d/%7d queue %6d\r" % (cnt, total_jobs, writer.depth()))
+                else:
+                    sys.stdout.write("%7d/%7d\r" % (cnt, total_jobs))
+                #logging.debug("%s: %s" % (pdf.name, pdf.ftr_vec))
+                if pdf:
+                    e_md5 = get_hash(str(pdf.e))
+                    graph_db.save(pdf.name, get_hash(str(pdf.v)), e_md5, pdf.v, pdf.e, pdf.ftr_vec)
+                    if hashes[path]:
+                        graph_db.save_content(hashes[path], pdf.name)
+                    family_index.insert(e_md5, pdf.name, pdf.ftr_vec)
+                    store.add(e_md5, pdf.name, pdf.ftr_vec)
+                    if xml_db:
+                        xml_db.save_tree(pdf.name, *pdf.tree, path=path)
+                else:
+                    logging.warning("main.build_graphdb %s: %s" % (status, path))
+                job_db.mark(argv.job_id, path, status)
+                statuses[path] = status
+                window.done()
+
+            for path, first in repeats:
+                if first not in statuses:
+                    continue
+                if statuses[first] == job_db.COMPLETE:
+                    graph_db.copy_pdf(os.path.basename(first), os.path.basename(path))
+                    if xml_db:
+                        xml_db.copy(os.path.basename(first), os.path.basename(path), path)
+                job_db.mark(argv.job_id, path, statuses[first])
+        except KeyboardInterrupt:
+            logging.warning("\nTerminating pool...\n")
+            window.close()
+            p.terminate()
+        except pool.MaybeEncodingError as e:
+            logging.error("main.build_graphdb imap error: %s" % e)
+            window.close()
+
+    if xml_db:
+        xml_db.close()
+    family_index.save()
+    store.flush()
+    shutdown(p, job_db)
 
-    :param v: set of vertices (label, [attrib])
-    :type v:  list
-    :param e: edges in the graph (vertex, vertex)
-    :type e: list
-    :return: a vector of features
-    :rtype: list
-    """
-    graph = nx.Graph()
-    for label, attrs in v:
-        graph.add_node(label, contains=attrs)
-    for edge in e:
-        graph.add_edge(*edge)
 
+def refeature_graphdb(argv, graph_db, xml_db):
+    """ Rebuild the graph and features of every archived pdf from its xml, without reparsing
     """
-    Transforms matrix from paper, so that each row is a feature, and each col is a node
-    """
-    features = [[] for i in range(NUMFEATURES)]
-    for node in graph.nodes_iter():
-        for idx, ftr in enumerate(get_node_features(graph, node)):
-            features[idx].append(ftr)
-
-    return features
-
-
-def aggregate_ftr_matrix(ftr_matrix):
-    sig = []
-    for ftr in ftr_matrix:
-        median = stats.nanmedian(ftr)
-        mean = stats.nanmean(ftr)
-        std = stats.nanstd(ftr)
-        # Invalid double scalars warning appears here
-        skew = stats.skew(ftr) if any(ftr) else 0.0
-        kurtosis = stats.kurtosis(ftr)
-        sig.extend([median, mean, std, skew, kurtosis])
-    return sig
-
-
-def build_graphdb(argv, job_db, graph_db):
-
-    if not argv.update:
-        done = job_db.get_completed(argv.job_id)
-        argv.todo.difference_update(done)
-        del done
+    members = xml_db.tree_members()
+    logging.info("main.refeature_graphdb %d trees of %d pdfs" %
+                 (len(members), sum(len(pdf_ids) for pdf_ids in members.itervalues())))
 
     cnt = 0
-    total_jobs = len(argv.todo)
-
     p = Pool(argv.procs, maxtasksperchild=argv.chunk)
-
-    pfunc = parse.get_parser(argv.parser)
-    if not pfunc:
-        logging.error("main.build_graphdb could not find parser: %s" % argv.parser)
+    with graph_db.batch(argv.flush_rows, argv.flush_secs, argv.write_queue):
+        try:
+            # Pages are read here, the pool's task thread can not use the xml db connection
+            trees = xml_db.iter_trees()
+            for page in iter(lambda: list(itertools.islice(trees, REFEATURE_PAGE)), []):
+                for tree_md5, pdf in p.imap_unordered(refeature_job, page, argv.chunk):
+                    cnt += 1
+                    sys.stdout.write("%7d/%7d\r" % (cnt, len(members)))
+                    if not pdf or not pdf.ftr_vec:
+                        logging.warning("main.refeature_graphdb no features for tree %s" % tree_md5)
+                        continue
+                    v_md5, e_md5 = get_hash(str(pdf.v)), get_hash(str(pdf.e))
+                    for pdf_id in members.get(tree_md5, []):
+                        graph_db.save(pdf_id, v_md5, e_md5, pdf.v, pdf.e, pdf.ftr_vec)
+        except KeyboardInterrupt:
+            logging.warning("\nTerminating pool...\n")
+            p.terminate()
+    p.close()
+    p.join()
+
+    # Families keep their e_md5 when only the features change, so rebuild both
+    family_index = FamilyIndex.for_db(graph_db)
+    family_index.sync(graph_db, True)
+    family_index.save()
+    FeatureStore.for_db(graph_db).sync(graph_db, True)
+
+
+def serve_scores(argv, graph_db):
+    parse_func = parse.get_parser(argv.parser, graph_only=True, cache_bytes=argv.cache_mb << 20,
+                                  mapped=argv.mapped)
+    if not parse_func:
+        logging.error("main.serve_scores did not find valid parser: %s" % argv.parser)
         sys.exit(1)
 
+    family_index = FamilyIndex.for_db(graph_db)
+    if family_index.load() or argv.reindex:
+        family_index.sync(graph_db, argv.reindex)
+    else:
+        family_index = None
+
+    init_parse_job(parse_func, argv.timeout)
+    scorer = Scorer(graph_db, parse_job, family_index)
+    server = get_server(scorer, argv.socket or os.path.join(argv.dbdir, 'nabu.sock'), argv.port)
+    logging.info("main.serve_scores serving %d families on %s" % (len(scorer.families), server.server_address))
+    stop_on_signal(server)
     try:
-        for pdf in p.imap_unordered(pfunc, argv.todo, argv.chunk * argv.procs):
-            cnt += 1
-            sys.stdout.write("%7d/%7d\r" % (cnt, total_jobs))
-            #logging.debug("%s: %s" % (pdf.name, pdf.ftr_vec))
-            if pdf.ftr_vec:
-                graph_db.save(pdf.name, get_hash(str(pdf.v)), get_hash(str(pdf.e)), pdf.v, pdf.e, pdf.ftr_vec)
+        server.serve_forever()
     except KeyboardInterrupt:
-        logging.warning("\nTerminating pool...\n")
-        p.terminate()
-    except pool.MaybeEncodingError as e:
-        logging.error("main.build_graphdb imap error: %s" % e)
-
-    shutdown(p, job_db)
+        logging.warning("\nShutting down server...\n")
+    finally:
+        server.server_close()
+        if family_index:
+            family_index.save()
 
 
 def draw_clusters(argv, graph_db):
-    unique_graphs = [row[0] for row in graph_db.get_unique('e_md5')]
-    unique_num = len(unique_graphs)
+    from scipy.cluster.hierarchy import dendrogram, linkage
+    import matplotlib.pyplot as plt
+
+    unique_num = graph_db.count_families()
 
     logging.info('draw_clusters: Clustering %d graphs' % unique_num)
     '''
@@ -267,10 +483,9 @@ def draw_clusters(argv, graph_db):
     plock("Loading...")
     x = loadtxt('tmp.csv')
     '''
-    x = []
-    for edge_md5 in unique_graphs:
-        pdf_id, ftrs_b = graph_db.load_family_features(edge_md5)
-        x.append(ftrs_b)
+    store = FeatureStore.for_db(graph_db)
+    store.sync(graph_db)
+    x = store.matrix()
 
     plock("Calculating distances...")
     '''
@@ -292,19 +507,33 @@ def main(args):
 
         args.todo = parse_file_set(args.fin)
 
-    job_db = dbgw.JobDb(os.path.join(args.dbdir, args.jobdb))
-    graph_db = dbgw.GraphDb(os.path.join(args.dbdir, args.graphdb))
+    job_db = dbgw.JobDb(os.path.join(args.dbdir, args.jobdb), args.wal, args.sync)
+    if args.shards > 1:
+        graph_db = dbgw.ShardedGraphDb(os.path.join(args.dbdir, args.graphdb), args.shards, args.wal, args.sync)
+    else:
+        graph_db = dbgw.GraphDb(os.path.join(args.dbdir, args.graphdb), args.wal, args.sync)
 
     if not job_db.init(job_db.table, job_db.cols) \
             or not graph_db.init(graph_db.table, graph_db.cols):
         logging.error("main.main could not initialize db. exiting.")
         sys.exit(1)
 
+    xml_db = None
+    if args.archive or args.action == "refeature":
+        xml_db = dbgw.XmlDb(os.path.join(args.dbdir, args.xmldb), args.wal, args.sync)
+        if not xml_db.init(xml_db.table, xml_db.cols):
+            logging.error("main.main could not initialize xml db. exiting.")
+            sys.exit(1)
+
     start = time.clock()
     if args.action == "build":
         logging.info("main.main Building graph database")
-        build_graphdb(args, job_db, graph_db)
+        build_graphdb(args, job_db, graph_db, xml_db)
         logging.info("Build finished in ~ %.3f" % (time.clock() - start))
+    elif args.action == "refeature":
+        logging.info("main.main Rebuilding features from the xml archive")
+        refeature_graphdb(args, graph_db, xml_db)
+        logging.info("Refeature finished in ~ %.3f" % (time.clock() - start))
     elif args.action == "score":
         logging.info("main.main Scoring graphs")
         score_pdfs(args, job_db, graph_db)
@@ -314,19 +543,48 @@ def main(args):
         sys.stdout.write("Lets not do that write now\n")
         #draw_clusters(args, graph_db)
         logging.info("Clustering finished in ~ %.3f" % (time.clock() - start))
+    elif args.action == "serve":
+        logging.info("main.main Serving scores")
+        serve_scores(args, graph_db)
+    elif args.action == "compact":
+        logging.info("main.main Compacting graph database")
+        count = graph_db.compact()
+        if count < 0:
+            sys.exit(1)
+        logging.info("Compacted, migrated %d rows in ~ %.3f" % (count, time.clock() - start))
+    elif args.action == "migrate":
+        logging.info("main.main Migrating graph database")
+        count = graph_db.migrate()
+        if count < 0:
+            sys.exit(1)
+        logging.info("Migrated %d rows in ~ %.3f" % (count, time.clock() - start))
 
 
 if __name__ == "__main__":
     argparser = ArgumentParser()
 
     argparser.add_argument('action',
-                           help="build | score")
+                           help="build | score | cluster | serve | migrate | compact | refeature")
+    argparser.add_argument('--archive',
+                           action='store_true',
+                           default=False,
+                           help="Build: keep the parsed xml of each sample, compressed, in the xml database, "
+                                "so refeature can rebuild graphs and features without reparsing")
     argparser.add_argument('--fin',
                            help="line separated text file of samples to run")
     argparser.add_argument('-b', '--beginning',
                            action='store_true',
                            default=False,
                            help="Start from beginning. Don't resume job file based on completed")
+    argparser.add_argument('--batch',
+                           action='store_true',
+                           default=False,
+                           help="Score: parse every sample first, then score them all against the families in one pass")
+    argparser.add_argument('--cache-mb',
+                           type=int,
+                           default=64,
+                           help="Keep at most this many MB of parsed objects per sample, 0 keeps them all. "
+                                "Default is 64")
     argparser.add_argument('-c', '--chunk',
                            type=int,
                            default=1,
@@ -335,12 +593,28 @@ if __name__ == "__main__":
                            action='store_true',
                            default=False,
                            help="Spam the terminal with debug output")
+    argparser.add_argument('--flush-rows',
+                           type=int,
+                           default=1000,
+                           help="Commit database writes in batches of this many rows. Default is 1000")
+    argparser.add_argument('--flush-secs',
+                           type=float,
+                           default=5.0,
+                           help="Commit pending database writes at least this often. Default is 5 seconds")
     argparser.add_argument('-g', '--graphdb',
                            default='nabu-graphdb.sqlite',
                            help='Graph database filename. Default is nabu-graphdb.sqlite')
     argparser.add_argument('-j', '--jobdb',
                            default='nabu-jobs.sqlite',
                            help='Job database filename. Default is nabu-jobs.sqlite')
+    argparser.add_argument('-k', '--knn',
+                           type=int,
+                           default=0,
+                           help="Report only the k nearest families, using the family index.")
+    argparser.add_argument('--wal',
+                           default=False,
+                           action='store_true',
+                           help="Open the databases in write-ahead log mode")
     argparser.add_argument('--xmldb',
                            default='nabu-xml.sqlite',
                            help='xml database filename. Default is nabu-xml.sqlite')
@@ -353,18 +627,56 @@ if __name__ == "__main__":
     argparser.add_argument('--parser',
                            default='pdfminer',
                            help="Type of pdf parser to use. Default is pdfminer")
+    argparser.add_argument('--mapped',
+                           action='store_true',
+                           default=False,
+                           help="Parse: map each sample into memory and tokenize it with a regex instead of "
+                                "reading it in blocks")
     argparser.add_argument('-p', '--procs',
                            type=int,
                            default=cpu_count(),
                            help="Number of parallel processes. Default is 2/3 cpu core count")
+    argparser.add_argument('--port',
+                           type=int,
+                           default=0,
+                           help="Serve: listen for HTTP on this localhost port instead of a UNIX socket")
+    argparser.add_argument('--reindex',
+                           default=False,
+                           action='store_true',
+                           help="Rebuild the family index and feature store from the graph database before scoring")
+    argparser.add_argument('--retry',
+                           default=False,
+                           action='store_true',
+                           help="Build: retry samples that failed or timed out in a previous run of the job")
+    argparser.add_argument('--shards',
+                           type=int,
+                           default=1,
+                           help="Split the graph database over this many files, by pdf. Use the same number for "
+                                "every action on the database. Default is 1")
+    argparser.add_argument('--socket',
+                           default='',
+                           help="Serve: UNIX socket path. Default is .../nabu/db/nabu.sock")
+    argparser.add_argument('--sync',
+                           choices=['off', 'normal', 'full'],
+                           help="SQLite synchronous pragma for the databases. Default is the SQLite default")
     argparser.add_argument('-t', '--thresh',
+                           type=float,
+                           default=0,
+                           help="Threshold which reports only graphs with similarities at or below this value. "
+                                "Uses the family index.")
+    argparser.add_argument('--timeout',
                            type=int,
                            default=0,
-                           help="Threshold which reports only graphs with similarities at or below this value.")
+                           help="Build, serve: give up parsing a sample after this many seconds. Default is no limit")
     argparser.add_argument('-u', '--update',
                            default=False,
                            action='store_true',
                            help="Ignore completed jobs")
+    argparser.add_argument('--write-queue',
+                           type=int,
+                           default=10000,
+                           help="Build: write to the database from a separate thread that queues at most this many "
+                                "rows, 0 writes from the main loop. Default is 10000")
 
     args = argparser.parse_args()
 
@@ -0,0 +1,101 @@
+""" Content addressed parse cache
+
+Samples are keyed by the md5 of their bytes, so byte identical pdfs stored under
+other names resolve to the graph already in GraphDb instead of being parsed again.
+"""
+import hashlib
+import logging
+import os
+from multiprocessing.pool import ThreadPool
+
+from process.pdf import PDF
+
+READSIZE = 1 << 20
+
+
+def get_hash(data):
+    md5 = hashlib.md5()
+    md5.update(data)
+    return md5.hexdigest()
+
+
+def hash_file(path):
+    md5 = hashlib.md5()
+    try:
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(READSIZE), ''):
+                md5.update(block)
+    except IOError as e:
+        logging.warning("hash_file unable to read %s: %s" % (path, e))
+        return None
+    return md5.hexdigest()
+
+
+def hash_files(paths, threads=4):
+    """ Yield hash_file of each path in order, hashing on threads since it mostly waits on reads
+    """
+    workers = ThreadPool(threads)
+    try:
+        for content_md5 in workers.imap(hash_file, paths, 16):
+            yield content_md5
+    finally:
+        workers.terminate()
+
+
+def copy_cached(graph_db, path, pdf_id):
+    """ Save the graph_db row of pdf_id again under the name of path
+
+    :return: PDF for path with the cached graph and features, or None
+    :rtype: PDF
+    """
+    name, v_md5, e_md5, v, e, ftrs = graph_db.load_pdf_graph(pdf_id)
+    if not len(ftrs):
+        return None
+    pdf = PDF(path, os.path.basename(path))
+    pdf.v, pdf.e, pdf.ftr_vec = v, e, ftrs
+    pdf.parsed = True
+    graph_db.copy_pdf(pdf_id, pdf.name)
+    return pdf
+
+
+def load_cached(graph_db, path, content_md5):
+    """ copy_cached for the row of identical content, None when there is none
+    """
+    if not content_md5:
+        return None
+    pdf_id = graph_db.lookup_content(content_md5)
+    if not pdf_id:
+        return None
+    return copy_cached(graph_db, path, pdf_id)
+
+
+def resolve(graph_db, todo, hashes):
+    """ Split samples by what the cache already knows
+
+    :param todo: sample paths
+    :type todo: list
+    :param hashes: content md5 of each sample, in the same order as todo
+    :type hashes: iterable
+    :return: samples to parse with their content md5 ({path: md5}),
+             samples already in graph_db ([(path, pdf_id)]),
+             repeats of a sample still to be parsed ([(path, first path)])
+    :rtype: tuple
+    """
+    parse = {}
+    cached = []
+    repeats = []
+    first = {}
+    for path, content_md5 in zip(todo, hashes):
+        if not content_md5:
+            parse[path] = None
+            continue
+        if content_md5 in first:
+            repeats.append((path, first[content_md5]))
+            continue
+        pdf_id = graph_db.lookup_content(content_md5)
+        if pdf_id:
+            cached.append((path, pdf_id))
+            continue
+        first[content_md5] = path
+        parse[path] = content_md5
+    return parse, cached, repeats
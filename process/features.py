@@ -0,0 +1,300 @@
+""" NetSimile node features for every node at once, over a sparse adjacency matrix
+
+For each node: degree, clustering coefficient, average degree of its neighbors,
+average clustering coefficient of its neighbors, number of edges in its egonet,
+number of edges leaving its egonet and number of neighbors of its egonet.
+
+The values reproduce the networkx implementation, netsimile_nx, including how it
+treats self loops and counts edges back to the ego node as outgoing.
+"""
+import numpy as np
+from scipy import sparse
+
+NUMFEATURES = 7
+BLOCKSIZE = 256
+STREAM_NODES = 100000
+
+
+def adjacency(v, e):
+    """ Undirected, unweighted adjacency of the pdf graph
+
+    :param v: vertices (label, [attrib])
+    :type v: list
+    :param e: edges (vertex, vertex)
+    :type e: list
+    :return: node labels, adjacency without self loops (csr), self loop indicator
+    :rtype: tuple
+    """
+    index = {}
+    for label, attrs in v:
+        index.setdefault(label, len(index))
+    src = np.empty(len(e), dtype=np.int64)
+    dst = np.empty(len(e), dtype=np.int64)
+    for idx, (a, b) in enumerate(e):
+        src[idx] = index.setdefault(a, len(index))
+        dst[idx] = index.setdefault(b, len(index))
+
+    n = len(index)
+    loops = np.zeros(n)
+    loops[src[src == dst]] = 1.0
+
+    keep = src != dst
+    rows = np.concatenate((src[keep], dst[keep]))
+    cols = np.concatenate((dst[keep], src[keep]))
+    adj = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n)).tocsr()
+    # Repeated edges collapse to one, as in networkx.Graph
+    adj.data[:] = 1.0
+
+    labels = [None] * n
+    for label, idx in index.iteritems():
+        labels[idx] = label
+    return labels, adj, loops
+
+
+def iter_feature_blocks(adj, loops, blocksize=BLOCKSIZE):
+    """ Yield (start, 7 x blocksize feature array) for consecutive blocks of nodes
+
+    Only the two-hop product of one block of rows is held in memory at a time.
+    """
+    n = adj.shape[0]
+    deg = np.asarray(adj.sum(axis=1)).ravel()
+    loop_diag = sparse.diags(loops, 0)
+    closed = (adj + loop_diag).tocsr()
+    nbr_loops = adj.dot(loops)
+
+    # triangles counts ordered pairs of connected neighbors, twice the triangle count
+    triangles = np.zeros(n)
+    ego_in = np.zeros(n)
+    ego_reach = np.zeros(n)
+    for lo in range(0, n, blocksize):
+        blk = slice(lo, min(lo + blocksize, n))
+        rows = adj[blk]
+        two_hop = rows.dot(adj)
+        triangles[blk] = np.asarray(two_hop.multiply(rows).sum(axis=1)).ravel()
+        two_hop = (two_hop + rows.dot(loop_diag)).tocsr()
+        ego_in[blk] = np.asarray(two_hop.multiply(closed[blk]).sum(axis=1)).ravel()
+        reach = (two_hop + closed[blk]).tocsr()
+        reach.eliminate_zeros()
+        ego_reach[blk] = reach.getnnz(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        clustering = np.where(triangles > 0, triangles / (deg * (deg - 1)), 0.0)
+    degree = deg + 2 * loops
+    nbr_degree = closed.dot(degree)
+    nbr_clustering = closed.dot(clustering)
+    ego_out = adj.dot(deg) + nbr_loops - ego_in
+
+    for lo in range(0, n, blocksize):
+        blk = slice(lo, min(lo + blocksize, n))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg_two_hops = np.where(degree[blk] > 0, nbr_degree[blk] / degree[blk], 0.0)
+            avg_cl_coef = np.where(degree[blk] > 0, nbr_clustering[blk] / degree[blk], 0.0)
+        yield lo, np.vstack((degree[blk],
+                             clustering[blk],
+                             avg_two_hops,
+                             avg_cl_coef,
+                             deg[blk] + triangles[blk] / 2 + loops[blk] + nbr_loops[blk],
+                             ego_out[blk],
+                             ego_reach[blk] - deg[blk] - loops[blk]))
+
+
+def graph_features(v, e):
+    """ Graph features based on NetSimile paper
+
+    :param v: set of vertices (label, [attrib])
+    :type v:  list
+    :param e: edges in the graph (vertex, vertex)
+    :type e: list
+    :return: feature matrix, each row is a feature and each col is a node
+    :rtype: numpy.ndarray
+    """
+    labels, adj, loops = adjacency(v, e)
+    ftrs = np.empty((NUMFEATURES, len(labels)))
+    for lo, block in iter_feature_blocks(adj, loops):
+        ftrs[:, lo:lo + block.shape[1]] = block
+    return ftrs
+
+
+def aggregate(ftrs):
+    """ Aggregate a feature matrix into the graph signature in one vectorized pass
+
+    Per feature: median, mean, std, skew and kurtosis, with the same conventions as
+    scipy.stats nanmedian, nanmean, nanstd (unbiased), skew and kurtosis.
+
+    :param ftrs: NUMFEATURES x nodes feature matrix
+    :type ftrs: numpy.ndarray
+    :return: signature, NUMFEATURES * 5 values
+    :rtype: list
+    """
+    ftrs = np.asarray(ftrs, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        median = np.nanmedian(ftrs, axis=1)
+        mean = np.nanmean(ftrs, axis=1)
+        std = np.nanstd(ftrs, axis=1, ddof=1)
+        dev = ftrs - ftrs.mean(axis=1)[:, np.newaxis]
+        m2 = (dev ** 2).mean(axis=1)
+        m3 = (dev ** 3).mean(axis=1)
+        m4 = (dev ** 4).mean(axis=1)
+        skew = np.where(m2 == 0, 0.0, m3 / m2 ** 1.5)
+        kurtosis = np.where(m2 == 0, 0.0, m4 / m2 ** 2) - 3.0
+    # A feature that is zero for every node has no skew
+    skew[~ftrs.any(axis=1)] = 0.0
+    return np.column_stack((median, mean, std, skew, kurtosis)).ravel().tolist()
+
+
+class StreamingAggregate(object):
+    """ aggregate() over blocks of nodes, without keeping the feature matrix
+
+    Moments are merged block by block with Pebay's pairwise update. The median is
+    exact, from a count of each distinct feature value, so memory grows with the
+    number of distinct values rather than nodes. Features are assumed finite.
+    """
+
+    def __init__(self, width=NUMFEATURES):
+        self.n = 0
+        self.mean = np.zeros(width)
+        self.m2 = np.zeros(width)
+        self.m3 = np.zeros(width)
+        self.m4 = np.zeros(width)
+        self.nonzero = np.zeros(width, dtype=bool)
+        self.counts = [{} for i in range(width)]
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        nb = block.shape[1]
+        if not nb:
+            return
+        mean_b = block.mean(axis=1)
+        dev = block - mean_b[:, np.newaxis]
+        m2_b = (dev ** 2).sum(axis=1)
+        m3_b = (dev ** 3).sum(axis=1)
+        m4_b = (dev ** 4).sum(axis=1)
+
+        na = float(self.n)
+        n = na + nb
+        delta = mean_b - self.mean
+        m2_a, m3_a = self.m2, self.m3
+        self.m4 = self.m4 + m4_b + delta ** 4 * na * nb * (na * na - na * nb + nb * nb) / n ** 3 + \
+            6 * delta ** 2 * (na * na * m2_b + nb * nb * m2_a) / n ** 2 + 4 * delta * (na * m3_b - nb * m3_a) / n
+        self.m3 = m3_a + m3_b + delta ** 3 * na * nb * (na - nb) / n ** 2 + 3 * delta * (na * m2_b - nb * m2_a) / n
+        self.m2 = m2_a + m2_b + delta ** 2 * na * nb / n
+        self.mean = self.mean + delta * nb / n
+        self.n = int(n)
+        self.nonzero |= block.any(axis=1)
+
+        for counts, row in zip(self.counts, block):
+            values, freq = np.unique(row, return_counts=True)
+            for value, cnt in zip(values.tolist(), freq.tolist()):
+                counts[value] = counts.get(value, 0) + cnt
+
+    def median(self, counts):
+        lo, hi = (self.n - 1) / 2, self.n / 2
+        seen = 0
+        low = None
+        for value in sorted(counts):
+            seen += counts[value]
+            if low is None and seen > lo:
+                low = value
+            if seen > hi:
+                return (low + value) / 2.0
+        return float('nan')
+
+    def signature(self):
+        n = float(self.n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(self.m2 / (n - 1))
+            skew = np.where(self.m2 == 0, 0.0, np.sqrt(n) * self.m3 / self.m2 ** 1.5)
+            kurtosis = np.where(self.m2 == 0, 0.0, n * self.m4 / self.m2 ** 2) - 3.0
+        skew[~self.nonzero] = 0.0
+        median = np.array([self.median(counts) for counts in self.counts])
+        return np.column_stack((median, self.mean, std, skew, kurtosis)).ravel().tolist()
+
+
+def stream_signature(v, e):
+    """ Graph signature of the pdf graph, streaming node features block by block
+    """
+    labels, adj, loops = adjacency(v, e)
+    agg = StreamingAggregate()
+    for lo, block in iter_feature_blocks(adj, loops):
+        agg.update(block)
+    return agg.signature()
+
+
+def netsimile_nx(v, e):
+    """ Reference networkx implementation of graph_features, one node at a time
+
+    :return: feature matrix as lists, each row is a feature and each col is a node
+    :rtype: list
+    """
+    import networkx
+
+    graph = networkx.Graph()
+    for label, attrs in v:
+        graph.add_node(label, contains=attrs)
+    for edge in e:
+        graph.add_edge(*edge)
+
+    features = [[] for i in range(NUMFEATURES)]
+    for node in graph.nodes_iter():
+        neighbors = graph.neighbors(node)
+
+        degree = graph.degree(node)
+
+        cl_coef = networkx.clustering(graph, node)
+
+        nbrs_two_hops = 0.0
+        nbrs_cl_coef = 0.0
+        for neighbor in neighbors:
+            nbrs_two_hops += graph.degree(neighbor)
+            nbrs_cl_coef += networkx.clustering(graph, neighbor)
+
+        try:
+            avg_two_hops = nbrs_two_hops / degree
+            avg_cl_coef = nbrs_cl_coef / degree
+        except ZeroDivisionError:
+            avg_two_hops = 0.0
+            avg_cl_coef = 0.0
+
+        egonet = networkx.ego_graph(graph, node)
+
+        ego_size = egonet.size()
+
+        ego_out = 0
+        ego_nbrs = set()
+        for ego_node in egonet:
+            for nbr in graph.neighbors(ego_node):
+                if nbr not in neighbors:
+                    ego_out += 1
+                    ego_nbrs.add(nbr)
+
+        for idx, ftr in enumerate([degree, cl_coef, avg_two_hops, avg_cl_coef, ego_size, ego_out, len(ego_nbrs)]):
+            features[idx].append(ftr)
+
+    return features
+
+
+if __name__ == "__main__":
+    import random
+    import sys
+    from timeit import timeit
+
+    from process.parsers import pdfminer
+
+    graphs = []
+    for path in sys.argv[1:]:
+        pdf = pdfminer.parse_and_hash(path)
+        graphs.append((pdf.name, pdf.v, pdf.e))
+    for n in (100, 1000, 5000):
+        v = [(str(i), ['object']) for i in range(n)]
+        e = [(str(random.randrange(n)), str(random.randrange(i + 1))) for i in range(n) for j in range(2)]
+        e.extend((str(i), '0') for i in range(0, n, 7))
+        graphs.append(("random-%d" % n, v, e))
+
+    print "%-24s %8s %8s %10s %10s %8s" % ("graph", "nodes", "edges", "networkx", "sparse", "match")
+    for name, v, e in graphs:
+        reference = np.array(netsimile_nx(v, e), dtype=np.float64)
+        ftrs = graph_features(v, e)
+        match = np.allclose(np.sort(reference, axis=1), np.sort(ftrs, axis=1))
+        t_nx = timeit(lambda: netsimile_nx(v, e), number=1)
+        t_sp = timeit(lambda: graph_features(v, e), number=1)
+        print "%-24s %8d %8d %10.4f %10.4f %8s" % (name[:24], ftrs.shape[1], len(e), t_nx, t_sp, match)
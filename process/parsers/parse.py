@@ -1,15 +1,28 @@
-def get_pdfminer():
+import functools
+
+
+def get_pdfminer(graph_only=False, **opts):
     import pdfminer
-    return pdfminer.parse_and_hash
+    func = pdfminer.parse_graph if graph_only else pdfminer.parse_and_hash
+    if opts:
+        return functools.partial(func, **opts)
+    return func
 
 
-def get_peepdf():
+def get_peepdf(graph_only=False, **opts):
     pass
 
 
 PARSER_FACTORY_FUNCS = {'pdfminer': get_pdfminer, 'peepdf': get_peepdf}
 
 
-def get_parser(type_):
+def get_parser(type_, graph_only=False, **opts):
+    """
+    :param graph_only: the parser only needs to produce v, e and ftr_vec, not xml
+    :type graph_only: bool
+    :param opts: options of the parser, such as cache_bytes and mapped for pdfminer
+    """
     factory = PARSER_FACTORY_FUNCS.get(type_)
-    return factory()
+    if not factory:
+        return None
+    return factory(graph_only, **opts)
@@ -2,11 +2,10 @@ import logging
 import os
 import re
 import sys
-import gzip
-from xml.etree.ElementTree import TreeBuilder, tostring
+from xml.etree.ElementTree import Element, TreeBuilder, tostring
 
 from lib.parse.pdfminer import pdftypes
-from lib.parse.pdfminer.pdfdocument import PDFDocument
+from lib.parse.pdfminer.pdfdocument import LRUObjCache, PDFDocument
 from lib.parse.pdfminer.pdfparser import PDFParser
 from lib.parse.pdfminer.psparser import PSKeyword, PSLiteral
 
@@ -14,11 +13,15 @@ from process.pdf import PDF
 
 ESC_PAT = re.compile(r'[\000-\037&<>()"\042\047\134\177-\377]')
 ENC = 'base64'
-OUTPUTDIR = '/Volumes/Macintosh_HD_2/nabu-pdf-xml'
+CACHE_BYTES = 64 << 20
 
 
-def parse_and_hash(pdfpath):
-    parser = PDFMinerParser()
+def parse_graph(pdfpath, cache_bytes=CACHE_BYTES, mapped=False):
+    return parse_and_hash(pdfpath, graph_only=True, cache_bytes=cache_bytes, mapped=mapped)
+
+
+def parse_and_hash(pdfpath, graph_only=False, cache_bytes=CACHE_BYTES, mapped=False):
+    parser = PDFMinerParser(graph_only, cache_bytes, mapped)
     pdf = PDF(pdfpath, os.path.basename(pdfpath))
 
     try:
@@ -30,22 +33,86 @@ def parse_and_hash(pdfpath):
     finally:
         logging.debug("%s,features\n%d,%s" % (pdf.name, len(pdf.ftr_vec), pdf.ftr_vec))
 
-    if 0:
-        fout = os.path.join(OUTPUTDIR, "%s.xml.zip" % pdf.name)
-        try:
-            gzfp = gzip.open(fout, "wb", compresslevel=4)
-        except IOError as e:
-            logging.error("Parse and hash error opening xml output file: %s\n\t%s" % (fout, e))
-        else:
-            pdf.save_xml(gzfp)
-
     return pdf
 
 
-class PDFMinerParser(object):
+class GraphBuilder(object):
+    """ Stands in for TreeBuilder when only the graph is wanted
+
+    Keeps the tags and ref ids of each top level object, and the refs under the first
+    Root, just as PDF.get_objects and PDF.get_root would read them back from the xml,
+    including when an unbalanced end leaves an object open.
+    """
 
     def __init__(self):
-        self.treebuild = TreeBuilder()
+        self.stack = []
+        self.objects = []
+        self.root = None
+        self.root_depth = 0
+
+    def start(self, tag, attrs):
+        self.stack.append(tag)
+        depth = len(self.stack)
+        if depth == 2 and tag == "object":
+            self.objects.append((attrs.get("id"), [tag], []))
+        elif depth > 2 and self.stack[1] == "object":
+            src_id, tags, refs = self.objects[-1]
+            tags.append(tag)
+            if tag == "ref":
+                refs.append(attrs.get("id"))
+        if tag == "ref" and self.root_depth:
+            self.root.append(attrs.get("id"))
+        elif tag == "Root" and self.root is None:
+            self.root = []
+            self.root_depth = depth
+        if tag == "object":
+            return Element(tag, attrs)
+
+    def data(self, data):
+        pass
+
+    def end(self, tag):
+        last = self.stack.pop()
+        if len(self.stack) < self.root_depth:
+            self.root_depth = 0
+        assert last == tag, "end tag mismatch (expected %s, got %s)" % (last, tag)
+
+    def close(self):
+        return None
+
+    def get_root(self, name):
+        if self.root is None:
+            logging.warn("PDF.get_root: %s\tMissing root node" % name)
+        elif not self.root:
+            logging.warn("PDF.get_root: %s\tRoot missing reference object" % name)
+        else:
+            return self.root[0]
+        return None
+
+
+class PDFMinerParser(object):
+
+    def __init__(self, graph_only=False, cache_bytes=CACHE_BYTES, mapped=False):
+        """
+        :param graph_only: only collect the pdf graph, skip building and encoding the xml
+        :type graph_only: bool
+        :param cache_bytes: keep at most about this many bytes of parsed objects, 0 keeps them all
+        :type cache_bytes: int
+        :param mapped: read the file as one mmap buffer and tokenize it with the regex scanner
+        :type mapped: bool
+        """
+        self.graph_only = graph_only
+        self.cache_bytes = cache_bytes
+        self.mapped = mapped
+        if graph_only:
+            self.treebuild = GraphBuilder()
+        else:
+            self.treebuild = TreeBuilder()
+
+    def encode(self, data):
+        if self.graph_only:
+            return ''
+        return self.esc(data).encode(ENC)
 
     @staticmethod
     def esc(s):
@@ -86,7 +153,7 @@ class PDFMinerParser(object):
             self.treebuild.end("list")
 
         elif isinstance(obj, str):
-            self.add_xml_node("string", obj_attrs.update({"enc": ENC}), self.esc(obj).encode(ENC))
+            self.add_xml_node("string", obj_attrs.update({"enc": ENC}), self.encode(obj))
 
         elif isinstance(obj, pdftypes.PDFStream):
             self.treebuild.start("stream", obj_attrs)
@@ -104,7 +171,7 @@ class PDFMinerParser(object):
             except Exception as e:
                 self.add_xml_node("error", {"type": "Uncaught"}, e.message)
             else:
-                self.add_xml_node("data", attrs={"enc": ENC, "size": str(len(data))}, data=self.esc(data).encode(ENC))
+                self.add_xml_node("data", attrs={"enc": ENC, "size": str(len(data))}, data=self.encode(data))
                 """
                 Check js? swf?
                 """
@@ -133,8 +200,8 @@ class PDFMinerParser(object):
             logging.error("PDFMinerParser.parse unable to open PDF: %s" % e)
             return
 
-        parser = PDFParser(fp)
-        doc = PDFDocument(parser)
+        parser = PDFParser(fp, mapped=self.mapped)
+        doc = PDFDocument(parser, cache=LRUObjCache(self.cache_bytes) if self.cache_bytes else None)
 
         if doc.found_eof and doc.eof_distance > 3:
             pdf.blob = parser.read_from_end(doc.eof_distance)
@@ -159,14 +226,17 @@ class PDFMinerParser(object):
                     self.dump(doc.getobj(objid))
                 except pdftypes.PDFObjectNotFound as e:
                     obj_xml.set("type", "malformed")
-                    obj_data = parser.read_n_from(xref.get_pos(objid)[1], 4096)
-                    obj_data = obj_data.replace('<', '0x3C')
+                    if not self.graph_only:
+                        obj_data = parser.read_n_from(xref.get_pos(objid)[1], 4096)
+                        obj_data = obj_data.replace('<', '0x3C')
                 except TypeError:
                     obj_xml.set("type", "unknown")
-                    obj_data = parser.read_n_from(xref.get_pos(objid)[1], 512)
+                    if not self.graph_only:
+                        obj_data = parser.read_n_from(xref.get_pos(objid)[1], 512)
                 except Exception as e:
                     obj_xml.set("type", "exception")
-                    obj_data = parser.read_n_from(xref.get_pos(objid)[1], 512)
+                    if not self.graph_only:
+                        obj_data = parser.read_n_from(xref.get_pos(objid)[1], 512)
                     self.add_xml_node("exception", {}, e.message)
 
                 self.treebuild.data(obj_data)
@@ -183,8 +253,12 @@ class PDFMinerParser(object):
         self.treebuild.end("pdf")
 
         pdf.xml = self.treebuild.close()
+        if self.graph_only:
+            pdf.set_nodes_edges(self.treebuild.get_root(pdf.name), self.treebuild.objects)
 
         pdf.errors = doc.errors
         pdf.bytes_read = parser.BYTES
         pdf.parsed = True
+        logging.debug("PDFMinerParser.parse %s object cache %s" % (pdf.name, doc.cache.stats()))
+        parser.close()
         fp.close()
@@ -0,0 +1,169 @@
+import logging
+
+import numpy as np
+
+NUMSIGNATURE = 35
+SUBJECT_BLOCK = 32
+FAMILY_BLOCK = 1024
+
+_shared = {}
+
+
+def canberra_rows(u, x):
+    """ Canberra distance from vector u to every row of matrix x
+
+    Matches scipy.spatial.distance.canberra, where 0/0 terms count as 0.
+
+    :param u: feature vector
+    :type u: numpy.ndarray
+    :param x: one feature vector per row
+    :type x: numpy.ndarray
+    :return: distances, one per row of x
+    :rtype: numpy.ndarray
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        terms = np.abs(x - u) / (np.abs(x) + np.abs(u))
+    terms[np.isnan(terms)] = 0.0
+    return terms.sum(axis=1)
+
+
+def canberra_block(u, x):
+    """ Canberra distances between every row of u and every row of x
+
+    :return: len(u) by len(x) distance matrix
+    :rtype: numpy.ndarray
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        terms = np.abs(x[np.newaxis, :, :] - u[:, np.newaxis, :]) / \
+            (np.abs(x)[np.newaxis, :, :] + np.abs(u)[:, np.newaxis, :])
+    terms[np.isnan(terms)] = 0.0
+    return terms.sum(axis=2)
+
+
+def share_blocks(subjects, families, thresh):
+    """ Pool initializer for score_block, workers inherit both matrices on fork
+    """
+    _shared['subjects'] = subjects
+    _shared['families'] = families
+    _shared['thresh'] = thresh
+
+
+def iter_blocks(num_subjects, num_families):
+    for s_lo in range(0, num_subjects, SUBJECT_BLOCK):
+        for f_lo in range(0, num_families, FAMILY_BLOCK):
+            yield s_lo, f_lo
+
+
+def score_block(offsets):
+    """ Score one SUBJECT_BLOCK x FAMILY_BLOCK tile and return its report lines
+    """
+    s_lo, f_lo = offsets
+    subjects, families, thresh = _shared['subjects'], _shared['families'], _shared['thresh']
+    f_hi = min(f_lo + FAMILY_BLOCK, len(families))
+    names = subjects.ids[s_lo:s_lo + SUBJECT_BLOCK]
+    dists = canberra_block(subjects.matrix[s_lo:s_lo + len(names)], families.matrix[f_lo:f_hi])
+    if thresh:
+        hits = zip(*np.nonzero(dists <= thresh))
+    else:
+        hits = ((s, f) for s in range(dists.shape[0]) for f in range(dists.shape[1]))
+    lines = []
+    for s, f in hits:
+        edge_md5, pdf_id = families.ids[f_lo + f]
+        lines.append("%s,%s,%s,%f\n" % (names[s][1], edge_md5, pdf_id, dists[s, f]))
+    return lines
+
+
+class FamilyMatrix(object):
+    """ Family feature vectors as one contiguous float64 matrix, one row per e_md5
+
+    Rows with missing, short, nan or inf features are masked out when loaded, so they
+    never reach the distance kernel.
+    """
+
+    def __init__(self, width=NUMSIGNATURE):
+        self.width = width
+        self.ids = []
+        self.families = set()
+        self.matrix = np.empty((0, width), dtype=np.float64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def valid(self, ftrs):
+        try:
+            vec = np.asarray(ftrs, dtype=np.float64)
+        except (TypeError, ValueError):
+            return None
+        if vec.shape != (self.width,) or not np.isfinite(vec).all():
+            return None
+        return vec
+
+    def reserve(self, rows):
+        if rows <= self.matrix.shape[0]:
+            return
+        grown = np.empty((max(rows, 2 * self.matrix.shape[0]), self.width), dtype=np.float64)
+        grown[:self.size] = self.matrix[:self.size]
+        self.matrix = grown
+
+    def add(self, e_md5, pdf_id, ftrs):
+        if e_md5 in self.families:
+            return False
+        vec = self.valid(ftrs)
+        if vec is None:
+            logging.warning("FamilyMatrix masking bad features for %s (%s)" % (pdf_id, e_md5))
+            return False
+        self.reserve(self.size + 1)
+        self.matrix[self.size] = vec
+        self.ids.append((e_md5, pdf_id))
+        self.families.add(e_md5)
+        self.size += 1
+        return True
+
+    def load(self, graph_db):
+        self.reserve(self.size + graph_db.count_families())
+        for e_md5, pdf_id, ftrs in graph_db.iter_families():
+            self.add(e_md5, pdf_id, ftrs)
+        logging.debug("FamilyMatrix loaded %d families" % self.size)
+        return self.size
+
+    def map(self, store):
+        """ Share the memory mapped rows of a storage.featurestore.FeatureStore, which
+        only holds valid rows. The matrix is copied the first time add() grows it.
+        """
+        self.matrix = store.matrix()
+        self.ids = list(store.ids)
+        self.families = set(store.families)
+        self.size = len(self.ids)
+        return self.size
+
+    def distances(self, ftrs):
+        vec = self.valid(ftrs)
+        if vec is None:
+            return None
+        return canberra_rows(vec, self.matrix[:self.size])
+
+    def scores(self, ftrs, thresh=0):
+        """ (e_md5, pdf_id, distance) for every family, or those at or below thresh
+        """
+        dists = self.distances(ftrs)
+        if dists is None:
+            return []
+        if thresh:
+            rows = np.flatnonzero(dists <= thresh)
+        else:
+            rows = np.arange(self.size)
+        return [self.ids[row] + (dists[row],) for row in rows]
+
+    def nearest(self, ftrs, k, thresh=0):
+        """ The k closest (e_md5, pdf_id, distance) families, nearest first
+        """
+        dists = self.distances(ftrs)
+        if dists is None:
+            return []
+        if k < len(dists):
+            rows = np.argpartition(dists, k)[:k]
+        else:
+            rows = np.arange(len(dists))
+        rows = rows[np.argsort(dists[rows])]
+        return [self.ids[row] + (dists[row],) for row in rows if not thresh or dists[row] <= thresh]
@@ -0,0 +1,161 @@
+""" Resident scoring daemon
+
+Requests and responses are single JSON objects, one per line on the UNIX socket or
+as the POST body over HTTP. A request names either a pdf to parse or a feature vector:
+
+    {"path": "/samples/x.pdf", "thresh": 2.5}
+    {"name": "x", "features": [35 floats], "knn": 10}
+
+    $ echo '{"path": "/samples/x.pdf"}' | nc -U db/nabu.sock
+    $ curl -d '{"path": "/samples/x.pdf"}' http://127.0.0.1:8000/
+"""
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import os
+import signal
+import threading
+
+from process import cache
+from process.cache import get_hash
+from process.scoring import FamilyMatrix
+
+
+class Scorer(object):
+    """ Family features, and the family index if there is one, held for the life of the daemon
+
+    parse_job parses one sample as main.parse_job does, giving up after the parse
+    timeout, and returns (path, job status, pdf or None).
+    """
+
+    def __init__(self, graph_db, parse_job, family_index=None):
+        self.graph_db = graph_db
+        self.parse_job = parse_job
+        self.family_index = family_index
+        self.families = FamilyMatrix()
+        self.families.load(graph_db)
+
+    def score(self, name, ftrs, thresh=0, knn=0):
+        if self.families.valid(ftrs) is None:
+            return {"subject": name, "error": "bad features"}
+        if self.family_index and (thresh or knn):
+            if knn:
+                found = self.family_index.knn(ftrs, knn, thresh or float('inf'))
+            else:
+                found = self.family_index.range(ftrs, thresh)
+            scores = [(edge_md5, pdf_id, can_dist) for can_dist, (edge_md5, pdf_id) in found]
+        elif knn:
+            scores = self.families.nearest(ftrs, knn, thresh)
+        else:
+            scores = self.families.scores(ftrs, thresh)
+        return {"subject": name,
+                "scores": [[edge_md5, pdf_id, float(can_dist)] for edge_md5, pdf_id, can_dist in scores]}
+
+    def score_pdf(self, path, thresh=0, knn=0):
+        if not os.path.isfile(path):
+            return {"subject": path, "error": "not a file"}
+        content_md5 = cache.hash_file(path)
+        pdf = cache.load_cached(self.graph_db, path, content_md5)
+        if pdf:
+            return self.score(pdf.name, pdf.ftr_vec, thresh, knn)
+        path, status, pdf = self.parse_job(path)
+        if pdf is None:
+            return {"subject": os.path.basename(path), "error": "parse %s" % status}
+        e_md5 = get_hash(str(pdf.e))
+        self.graph_db.save(pdf.name, get_hash(str(pdf.v)), e_md5, pdf.v, pdf.e, pdf.ftr_vec)
+        if content_md5:
+            self.graph_db.save_content(content_md5, pdf.name)
+        self.families.add(e_md5, pdf.name, pdf.ftr_vec)
+        if self.family_index:
+            self.family_index.insert(e_md5, pdf.name, pdf.ftr_vec)
+        return self.score(pdf.name, pdf.ftr_vec, thresh, knn)
+
+    def handle(self, line):
+        try:
+            request = json.loads(line)
+            thresh = float(request.get("thresh", 0))
+            knn = int(request.get("knn", 0))
+            if "path" in request:
+                response = self.score_pdf(request["path"], thresh, knn)
+            elif "features" in request:
+                response = self.score(request.get("name", ""), request["features"], thresh, knn)
+            else:
+                response = {"error": "request needs a path or features"}
+        except (ValueError, TypeError, AttributeError) as e:
+            response = {"error": "bad request: %s" % e}
+        except Exception as e:
+            logging.error("Scorer.handle uncaught exception: %s" % e)
+            response = {"error": "uncaught exception: %s" % e}
+        return json.dumps(response)
+
+
+class SocketRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write(self.server.scorer.handle(line) + '\n')
+                self.wfile.flush()
+
+
+class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400, "Bad Content-Length")
+            return
+        body = self.rfile.read(length)
+        response = self.server.scorer.handle(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response) + 1))
+        self.end_headers()
+        self.wfile.write(response + '\n')
+
+    def log_message(self, fmt, *args):
+        logging.debug("HTTPRequestHandler %s" % (fmt % args))
+
+
+class UnixScoreServer(SocketServer.UnixStreamServer):
+
+    def __init__(self, path, scorer):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, SocketRequestHandler)
+        self.scorer = scorer
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+class HTTPScoreServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, port, scorer):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), HTTPRequestHandler)
+        self.scorer = scorer
+
+
+def stop_on_signal(server, signum=signal.SIGTERM):
+    """ Shut server down on signum, so serve_forever returns and the caller's cleanup runs
+
+    shutdown() waits for serve_forever to return, so it is called from a thread of its own.
+    """
+    def handler(signum, frame):
+        logging.warning("Shutting down server on signal %d" % signum)
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signum, handler)
+
+
+def get_server(scorer, sock_path=None, port=0):
+    if port:
+        return HTTPScoreServer(port, scorer)
+    return UnixScoreServer(sock_path, scorer)
@@ -0,0 +1,114 @@
+""" Binary row formats of GraphDb
+
+Version 2, the current format:
+
+features  35 little endian float64, read back with numpy.frombuffer without a copy
+vertices  a string table of labels and tags, then ints: the vertex count, the label
+          of each vertex, the tag count of each vertex and the tags
+edges     a string table of labels, then ints: the (src, dst) label of each edge
+
+A string table blob is a header (strings, ints, int width), the string lengths and
+the ints, then the bytes of every interned string, so each repeated tag name or
+label is stored once. Ints are unsigned little endian, 1, 2 or 4 bytes wide,
+whichever is the narrowest that fits the blob. Vertices and edges blobs stand
+alone, so GraphDb can store each one once per v_md5 and e_md5.
+
+Version 0 is the original pickled rows, GraphDb.migrate rewrites them in this format.
+"""
+import struct
+
+import numpy as np
+
+VERSION = 2
+HEADER = struct.Struct('<2IB')
+INTS = {1: np.dtype('u1'), 2: np.dtype('<u2'), 4: np.dtype('<u4')}
+FLOAT = np.dtype('<f8')
+
+
+def encode_features(ftrs):
+    return buffer(np.asarray(ftrs, dtype=FLOAT).tostring())
+
+
+def decode_features(blob):
+    return np.frombuffer(blob, dtype=FLOAT)
+
+
+def int_width(value):
+    for width in (1, 2):
+        if value < 1 << (8 * width):
+            return width
+    return 4
+
+
+def pack_strings(strings, ints):
+    """
+    :param strings: interned strings, {string: index}
+    :type strings: dict
+    :param ints: ints to store after the string lengths
+    :type ints: list
+    :rtype: buffer
+    """
+    table = [None] * len(strings)
+    for s, idx in strings.iteritems():
+        table[idx] = s
+    ints = [len(s) for s in table] + ints
+    width = int_width(max(ints + [len(table)]))
+    return buffer(HEADER.pack(len(table), len(ints) - len(table), width) +
+                  np.array(ints, dtype=INTS[width]).tostring() + ''.join(table))
+
+
+def unpack_strings(blob):
+    """ Inverse of pack_strings
+
+    :return: string table, ints
+    :rtype: tuple
+    """
+    num_strings, num_ints, width = HEADER.unpack_from(blob)
+    ints = np.frombuffer(blob, dtype=INTS[width], count=num_strings + num_ints, offset=HEADER.size)
+    text = str(blob[HEADER.size + ints.nbytes:])
+    ends = np.cumsum(ints[:num_strings]).tolist()
+    return [text[lo:hi] for lo, hi in zip([0] + ends, ends)], ints[num_strings:]
+
+
+def encode_vertices(v):
+    """
+    :param v: vertices (label, [tags])
+    :type v: list
+    :rtype: buffer
+    """
+    strings = {}
+    labels = [strings.setdefault(label, len(strings)) for label, tags in v]
+    counts = [len(tags) for label, tags in v]
+    tag_ids = [strings.setdefault(tag, len(strings)) for label, tags in v for tag in tags]
+    return pack_strings(strings, [len(v)] + labels + counts + tag_ids)
+
+
+def decode_vertices(blob):
+    if not blob:
+        return []
+    table, ints = unpack_strings(blob)
+    num_v = int(ints[0])
+    labels = ints[1:num_v + 1].tolist()
+    tag_ends = np.cumsum(ints[num_v + 1:2 * num_v + 1]).tolist()
+    tags = [table[idx] for idx in ints[2 * num_v + 1:].tolist()]
+    return [(table[label], tags[lo:hi]) for label, lo, hi in zip(labels, [0] + tag_ends, tag_ends)]
+
+
+def encode_edges(e):
+    """
+    :param e: edges (label, label)
+    :type e: list
+    :rtype: buffer
+    """
+    strings = {}
+    ids = [strings.setdefault(label, len(strings)) for edge in e for label in edge]
+    return pack_strings(strings, ids)
+
+
+def decode_edges(blob):
+    if not blob:
+        return []
+    table, ints = unpack_strings(blob)
+    ids = ints.tolist()
+    return [(table[src], table[dst]) for src, dst in zip(ids[0::2], ids[1::2])]
+
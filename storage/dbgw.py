@@ -1,7 +1,193 @@
+import Queue
 import cPickle
+import hashlib
+import itertools
 import logging
+import os
 import sqlite3
 import sys
+import threading
+import time
+import zlib
+
+import codec
+
+
+def commit_rows(conn, pending, caller):
+    """ Commit the (cmd, [rows]) of pending in one transaction
+
+    If executemany fails, the transaction is rolled back and every row is run again
+    on its own, so only the rows sqlite refuses are dropped.
+
+    :return: number of rows dropped
+    :rtype: int
+    """
+    count = sum(len(rows) for cmd, rows in pending)
+    try:
+        with conn:
+            for cmd, rows in pending:
+                conn.executemany(cmd, rows)
+        return 0
+    except sqlite3.Error as e:
+        logging.warning("%s error, retrying %d rows one at a time: %s" % (caller, count, e))
+    dropped = 0
+    try:
+        with conn:
+            for cmd, rows in pending:
+                for row in rows:
+                    try:
+                        conn.execute(cmd, row)
+                    except sqlite3.Error as e:
+                        logging.error("%s dropped row %r: %s" % (caller, row[:2], e))
+                        dropped += 1
+    except sqlite3.Error as e:
+        logging.error("%s error, dropped %d rows: %s" % (caller, count, e))
+        return count
+    return dropped
+
+
+class BatchWriter(object):
+    """ Buffers writes to a NabuDb and commits them with executemany, one transaction per flush
+
+    Flushes once size rows are pending or interval seconds have passed since the last
+    flush, and on leaving the with block, even when leaving on KeyboardInterrupt. Rows
+    sqlite refuses are dropped, see commit_rows, and the rest are committed.
+    """
+
+    def __init__(self, db, size=1000, interval=5.0):
+        self.db = db
+        self.size = size
+        self.interval = interval
+        self.pending = []
+        self.count = 0
+        self.last = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def add(self, cmd, row):
+        if self.pending and self.pending[-1][0] == cmd:
+            self.pending[-1][1].append(row)
+        else:
+            self.pending.append((cmd, [row]))
+        self.count += 1
+        if self.count >= self.size or time.time() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        rv = True
+        if self.pending:
+            rv = commit_rows(self.db.conn, self.pending, "BatchWriter.flush") == 0
+            self.pending = []
+            self.count = 0
+        self.last = time.time()
+        return rv
+
+    def close(self):
+        self.flush()
+        if self.db.writer is self:
+            self.db.writer = None
+
+
+class AsyncWriter(threading.Thread):
+    """ BatchWriter on a thread of its own, with its own connection to the db
+
+    add() only queues the row, so the caller can go back to parsing while rows are
+    committed. The queue holds at most maxsize rows and add() blocks while it is
+    full, which holds back whoever is producing rows when the db is the slow part.
+    Queue depth is logged every interval seconds and kept in max_depth.
+    """
+
+    FLUSH = 'flush'
+    STOP = 'stop'
+
+    def __init__(self, db, size=1000, interval=5.0, maxsize=10000):
+        threading.Thread.__init__(self, name="AsyncWriter")
+        self.daemon = True
+        self.db = db
+        self.size = size
+        self.interval = interval
+        self.queue = Queue.Queue(maxsize)
+        self.max_depth = 0
+        self.written = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def put(self, item):
+        while True:
+            try:
+                self.queue.put(item, timeout=1.0)
+                return True
+            except Queue.Full:
+                if not self.is_alive():
+                    logging.error("AsyncWriter.put writer thread is gone")
+                    return False
+
+    def add(self, cmd, row):
+        self.put((cmd, row))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def flush(self):
+        """ Block until every row queued so far is committed
+        """
+        done = threading.Event()
+        if self.put((self.FLUSH, done)):
+            done.wait()
+
+    def close(self):
+        if self.is_alive():
+            self.put((self.STOP, None))
+            self.join()
+        if self.db.writer is self:
+            self.db.writer = None
+        logging.info("AsyncWriter wrote %d rows, %d failed, max queue depth %d" %
+                     (self.written, self.failed, self.max_depth))
+
+    def commit(self, conn, pending, count):
+        dropped = commit_rows(conn, pending, "AsyncWriter.commit")
+        self.written += count - dropped
+        self.failed += dropped
+
+    def run(self):
+        conn = self.db.connect()
+        pending = []
+        count = 0
+        last = reported = time.time()
+        while True:
+            try:
+                cmd, row = self.queue.get(timeout=max(0.01, last + self.interval - time.time()))
+            except Queue.Empty:
+                cmd, row = None, None
+            if cmd not in (None, self.FLUSH, self.STOP):
+                if pending and pending[-1][0] == cmd:
+                    pending[-1][1].append(row)
+                else:
+                    pending.append((cmd, [row]))
+                count += 1
+            if count >= self.size or cmd in (self.FLUSH, self.STOP) or time.time() - last >= self.interval:
+                if pending:
+                    self.commit(conn, pending, count)
+                pending, count, last = [], 0, time.time()
+            if cmd == self.FLUSH:
+                row.set()
+            elif cmd == self.STOP:
+                break
+            if time.time() - reported >= self.interval:
+                logging.info("AsyncWriter queue depth %d, max %d, %d rows written" %
+                             (self.queue.qsize(), self.max_depth, self.written))
+                reported = time.time()
+        conn.close()
 
 
 class NabuDb(object):
@@ -9,25 +195,61 @@ class NabuDb(object):
     table = "unknown"
     cols = []
 
-    def __init__(self, dbpath):
+    def __init__(self, dbpath, wal=False, synchronous=None):
+        """
+        :param wal: use write-ahead logging
+        :type wal: bool
+        :param synchronous: sqlite synchronous pragma, off | normal | full
+        :type synchronous: str
+        """
         self.dbpath = dbpath
         self.conn = None
+        self.writer = None
+        self.wal = wal
+        self.synchronous = synchronous
+        self.attached = []
+
+    def connect(self):
+        """ New connection to the db with its pragmas set and attached dbs attached
+        """
+        conn = sqlite3.connect(self.dbpath)
+        if self.wal:
+            conn.execute("pragma journal_mode=wal")
+        if self.synchronous:
+            conn.execute("pragma synchronous=%s" % self.synchronous)
+        for path, alias in self.attached:
+            conn.execute("attach database ? as %s" % alias, (path,))
+        conn.text_factory = str
+        return conn
 
     def init(self, table, cols):
         cmd = "create table if not exists %s(%s)" % (table, ','.join(cols))
         try:
-            self.conn = sqlite3.connect(self.dbpath)
+            self.conn = self.connect()
             self.conn.execute(cmd)
         except sqlite3.Error as e:
             logging.error("NabuDb.init error (%s): %s\n%s" % (self.dbpath, e, cmd))
             return False
         else:
-            self.conn.text_factory = str
             return True
 
     def connected(self):
         return self.conn is not None
 
+    def attach_db(self, path, alias):
+        """ Attach the db at path to this connection and to every connection made after
+        """
+        self.query("attach database ? as %s" % alias, (path,))
+        if alias not in [row[1] for row in self.query("pragma database_list", ())]:
+            return False
+        self.attached.append((path, alias))
+        return True
+
+    def shard(self, pdf):
+        """ The db that holds pdf's rows
+        """
+        return self
+
     def query(self, cmd, subs):
         try:
             c = self.conn.cursor()
@@ -37,10 +259,67 @@ class NabuDb(object):
             return []
         else:
             rows = c.fetchall()
-            self.conn.commit()
+            # Only statements that change the db commit, a select has a description
+            if c.description is None:
+                self.conn.commit()
             c.close()
             return rows
 
+    def stream(self, cols, table=None, join='', where='', subs=(), key='rowid', batch=500):
+        """ Yield rows a page at a time, with keyset pagination on key
+
+        Each page is its own "key > last" query, so a pass over the whole table
+        costs O(n) in total and holds one page in memory, and no cursor is left
+        open across the commits of writes made while iterating.
+
+        :param cols: columns to select, key is selected in front of them and dropped
+        :type cols: str
+        :param where: extra condition, and-ed with the key condition
+        :type where: str
+        :param subs: substitutions for where
+        :type subs: tuple
+        """
+        cmd = "select %s, %s from %s %s where %s > ? %s order by %s limit %d" % \
+              (key, cols, table or self.table, join, key, "and (%s)" % where if where else '', key, batch)
+        last = -(1 << 63)
+        while True:
+            try:
+                c = self.conn.execute(cmd, (last,) + tuple(subs))
+                rows = c.fetchmany(batch)
+                c.close()
+            except sqlite3.Error as e:
+                logging.error("NabuDb.stream error: %s" % e)
+                return
+            for row in rows:
+                yield row[1:]
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    def write(self, cmd, subs):
+        if self.writer:
+            self.writer.add(cmd, subs)
+            return []
+        return self.query(cmd, subs)
+
+    def batch(self, size=1000, interval=5.0, queue=0):
+        """ Route write() through a BatchWriter until the with block ends
+
+            with graph_db.batch(500):
+                graph_db.save(...)
+
+        :param queue: if set, write from an AsyncWriter thread that queues this many rows
+        :type queue: int
+        """
+        if self.writer:
+            self.writer.close()
+        if queue:
+            self.writer = AsyncWriter(self, size, interval, queue)
+            self.writer.start()
+        else:
+            self.writer = BatchWriter(self, size, interval)
+        return self.writer
+
     def size(self):
         cmd = "select count(*) from %s" % self.table
         rows = self.query(cmd, ())
@@ -55,48 +334,261 @@ class NabuDb(object):
         return rows
 
     def close(self):
+        if self.writer:
+            self.writer.close()
         self.conn.close()
 
 
 class JobDb(NabuDb):
 
     table = "jobs"
-    cols = ["job_name text", "sample_path text"]
+    cols = ["job_name text", "sample_path text", "status text default 'complete'"]
+
+    COMPLETE = 'complete'
+    FAILED = 'failed'
+    TIMEOUT = 'timeout'
+
+    def __init__(self, dbpath, wal=False, synchronous=None):
+        NabuDb.__init__(self, dbpath, wal, synchronous)
+        self.owner = self
+        self.prefix = ''
+
+    def init(self, table, cols):
+        if not NabuDb.init(self, table, cols):
+            return False
+        try:
+            have = [row[1] for row in self.conn.execute("pragma table_info(%s)" % table)]
+            if "status" not in have:
+                with self.conn:
+                    self.conn.execute("alter table %s add column %s" % (table, cols[2]))
+                    self.conn.execute("delete from %s where rowid not in "
+                                      "(select min(rowid) from %s group by job_name, sample_path)" % (table, table))
+            self.conn.execute("create unique index if not exists %s_job_sample on %s(job_name, sample_path)" %
+                              (table, table))
+        except sqlite3.Error as e:
+            logging.error("JobDb.init error (%s): %s" % (self.dbpath, e))
+            return False
+        return True
+
+    def attach(self, db, alias="jobdb"):
+        """ Write job records through db's connection, so they commit in the same transaction as db's rows
+
+        Each record goes through the shard that holds the sample's pdf, which is saved
+        under the basename of the sample path. In WAL mode sqlite only guarantees that
+        each database file commits atomically.
+        """
+        if not db.attach_db(self.dbpath, alias):
+            return False
+        self.owner = db
+        self.prefix = alias + '.'
+        return True
 
     def get_completed(self, job_name):
         cmd = "select sample_path from %s where job_name=?" % self.table
         rows = set([row[0] for row in self.query(cmd, (job_name,))])
         return rows
 
+    def filter_done(self, job_name, samples, statuses=(COMPLETE,), chunk=500):
+        """ Yield the samples that have no job record with one of statuses
+
+        Looks samples up a chunk at a time on the (job_name, sample_path) index instead
+        of loading every finished sample.
+        """
+        samples = iter(samples)
+        marks = ','.join('?' for status in statuses)
+        while True:
+            todo = list(itertools.islice(samples, chunk))
+            if not todo:
+                break
+            cmd = "select sample_path from %s where job_name=? and status in (%s) and sample_path in (%s)" % \
+                  (self.table, marks, ','.join('?' for sample in todo))
+            done = set(row[0] for row in self.query(cmd, (job_name,) + tuple(statuses) + tuple(todo)))
+            for sample in todo:
+                if sample not in done:
+                    yield sample
+
+    def mark(self, job_name, sample, status):
+        cmd = "insert or replace into %s%s values(?, ?, ?)" % (self.prefix, self.table)
+        return self.owner.shard(os.path.basename(sample)).write(cmd, (job_name, sample, status))
+
     def mark_complete(self, job_name, sample):
-        cmd = "insert into %s values(?, ?)" % self.table
-        rv = self.query(cmd, (job_name, sample))
-        return rv
+        return self.mark(job_name, sample, self.COMPLETE)
 
 
 class XmlDb(NabuDb):
+    """ Archive of parsed xml, so graphs and features can be rebuilt without reparsing
 
-    table = "xml"
-    cols = ["pdf_id primary key", "xml"]
+    Each distinct tree is stored once, zlib compressed, under the md5 of its xml,
+    and pdf_trees maps every pdf to its tree and sample path. The xml carries no
+    path, so samples with the same objects share one tree.
+    """
 
-    def save(self, pdf_id, xml_str):
-        cmd = "insert or replace into %s values(?, ?)" % self.table
-        return self.query(cmd, (pdf_id, xml_str))
+    table = "pdf_trees"
+    cols = ["pdf_id text primary key", "tree_md5 text", "path text"]
+    tree_table = "trees"
+    tree_cols = ["tree_md5 text primary key", "xml blob"]
+
+    def init(self, table, cols):
+        if not NabuDb.init(self, table, cols):
+            return False
+        try:
+            have = [row[1] for row in self.conn.execute("pragma table_info(%s)" % table)]
+            if "path" not in have:
+                self.conn.execute("alter table %s add column %s" % (table, cols[2]))
+            self.conn.execute("create table if not exists %s(%s)" % (self.tree_table, ','.join(self.tree_cols)))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error("XmlDb.init error (%s): %s" % (self.dbpath, e))
+            return False
+        return True
+
+    @staticmethod
+    def pack(xml_str):
+        """ Compress an xml string for save_tree, cheap to call from a pool worker
+
+        :return: tree_md5, compressed xml
+        :rtype: tuple
+        """
+        return hashlib.md5(xml_str).hexdigest(), zlib.compress(xml_str, 6)
+
+    def save_tree(self, pdf_id, tree_md5, blob, path=''):
+        self.write("insert or ignore into %s values(?, ?)" % self.tree_table, (tree_md5, buffer(blob)))
+        return self.write("insert or replace into %s values(?, ?, ?)" % self.table, (pdf_id, tree_md5, path))
+
+    def save(self, pdf_id, xml_str, path=''):
+        return self.save_tree(pdf_id, *self.pack(xml_str), path=path)
+
+    def copy(self, src, dst, path=''):
+        """ Point dst at the tree of src, if src is archived
+        """
+        cmd = "insert or replace into %s select ?, tree_md5, ? from %s where pdf_id=?" % (self.table, self.table)
+        return self.write(cmd, (dst, path, src))
 
     def load(self, pdf_id):
-        cmd = "select xml from %s where pdf_id=?" % self.table
+        cmd = "select t.xml from %s p join %s t on t.tree_md5 = p.tree_md5 where p.pdf_id=?" % \
+              (self.table, self.tree_table)
         rows = self.query(cmd, (pdf_id,))
         try:
-            rv = rows[0][0]
+            rv = zlib.decompress(rows[0][0])
         except Exception:
             rv = ''
         return rv
 
+    def tree_members(self):
+        """
+        :return: {tree_md5: [pdf_id]}
+        :rtype: dict
+        """
+        members = {}
+        for pdf_id, tree_md5 in self.stream("pdf_id, tree_md5"):
+            members.setdefault(tree_md5, []).append(pdf_id)
+        return members
+
+    def iter_trees(self, batch=100):
+        """ Stream (tree_md5, compressed xml) for every distinct tree, the xml as a str so
+        it can be sent to pool workers
+        """
+        for tree_md5, blob in self.stream("tree_md5, xml", self.tree_table, batch=batch):
+            yield tree_md5, str(blob)
+
 
 class GraphDb(NabuDb):
 
     table = "results"
     cols = ["pdf_id primary key", "v_md5", "e_md5", "vertices", "edges", "features"]
+    content_table = "content"
+    content_cols = ["content_md5 text primary key", "pdf_id text"]
+    family_table = "families"
+    family_cols = ["e_md5 text primary key", "pdf_id text", "members integer", "features"]
+    vertex_table = "v_blobs"
+    edge_table = "e_blobs"
+    PICKLE = 0
+
+    # families holds one row per e_md5 of results: its first pdf, member count and
+    # features. Replacing a row in results fires the delete trigger as well, since
+    # init turns on recursive_triggers. The outer "insert or replace" would override
+    # an "or ignore" in the trigger body, hence the "where not exists".
+    family_triggers = [
+        """create trigger if not exists %(results)s_family_insert after insert on %(results)s begin
+            insert into %(families)s select new.e_md5, new.pdf_id, 0, new.features
+                where not exists (select 1 from %(families)s where e_md5 = new.e_md5);
+            update %(families)s set members = members + 1 where e_md5 = new.e_md5;
+        end""",
+        """create trigger if not exists %(results)s_family_delete after delete on %(results)s begin
+            update %(families)s set members = members - 1 where e_md5 = old.e_md5;
+            delete from %(families)s where e_md5 = old.e_md5 and members <= 0;
+            update %(families)s set
+                pdf_id = (select pdf_id from %(results)s where e_md5 = old.e_md5 order by rowid limit 1),
+                features = (select features from %(results)s where e_md5 = old.e_md5 order by rowid limit 1)
+                where e_md5 = old.e_md5 and pdf_id = old.pdf_id;
+        end""",
+        """create trigger if not exists %(results)s_family_update after update of features on %(results)s begin
+            update %(families)s set features = new.features where e_md5 = new.e_md5 and pdf_id = new.pdf_id;
+        end""",
+    ]
+
+    def __init__(self, dbpath, wal=False, synchronous=None):
+        NabuDb.__init__(self, dbpath, wal, synchronous)
+        self.version = codec.VERSION
+
+    def sidecar(self, ext):
+        """ Path of a file kept beside the db, such as the family index
+        """
+        return self.dbpath + ext
+
+    def init(self, table, cols):
+        """ Rows are stored in the format recorded in pragma user_version. A new db
+        starts at codec.VERSION, older dbs keep their format until migrate()
+        """
+        if os.path.exists(shard_path(self.dbpath, 0)):
+            logging.error("GraphDb.init %s was built with --shards, open it with the same number of shards" %
+                          self.dbpath)
+            return False
+        if not NabuDb.init(self, table, cols):
+            return False
+        try:
+            self.conn.execute("create table if not exists %s(%s)" % (self.content_table, ','.join(self.content_cols)))
+            self.conn.execute("create index if not exists %s_pdf_id on %s(pdf_id)" %
+                              (self.content_table, self.content_table))
+            self.init_families(table)
+            for blobs, col in ((self.vertex_table, 'v_md5'), (self.edge_table, 'e_md5')):
+                self.conn.execute("create table if not exists %s(%s text primary key, data blob)" % (blobs, col))
+            self.version = self.conn.execute("pragma user_version").fetchone()[0]
+            if self.version == self.PICKLE and not self.conn.execute("select 1 from %s limit 1" % table).fetchone():
+                self.conn.execute("pragma user_version=%d" % codec.VERSION)
+                self.version = codec.VERSION
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error("GraphDb.init error (%s): %s" % (self.dbpath, e))
+            return False
+        if self.version not in (self.PICKLE, codec.VERSION):
+            logging.error("GraphDb.init %s uses row format %d, this version of nabu reads %d and %d" %
+                          (self.dbpath, self.version, self.PICKLE, codec.VERSION))
+            return False
+        if self.version == self.PICKLE:
+            logging.warning("GraphDb.init %s uses row format %d, run migrate to upgrade it to %d" %
+                            (self.dbpath, self.version, codec.VERSION))
+        return True
+
+    def connect(self):
+        conn = NabuDb.connect(self)
+        # The families triggers rely on it
+        conn.execute("pragma recursive_triggers=on")
+        return conn
+
+    def init_families(self, table):
+        self.conn.execute("create index if not exists %s_e_md5 on %s(e_md5)" % (table, table))
+        exists = self.conn.execute("select 1 from sqlite_master where type='table' and name=?",
+                                   (self.family_table,)).fetchone()
+        self.conn.execute("create table if not exists %s(%s)" % (self.family_table, ','.join(self.family_cols)))
+        for trigger in self.family_triggers:
+            self.conn.execute(trigger % {'results': table, 'families': self.family_table})
+        if not exists:
+            # Databases from before the families table, fill it from results
+            self.conn.execute("insert into %(families)s select r.e_md5, r.pdf_id, f.members, r.features "
+                              "from %(results)s r join (select min(rowid) first, count(*) members "
+                              "from %(results)s group by e_md5) f on r.rowid = f.first" %
+                              {'results': table, 'families': self.family_table})
 
     @staticmethod
     def serialize(data):
@@ -118,44 +610,350 @@ class GraphDb(NabuDb):
         else:
             return data
 
+    def load_graph(self, v_data, e_data):
+        if self.version == self.PICKLE:
+            return self.deserialize(v_data), self.deserialize(e_data)
+        return codec.decode_vertices(v_data), codec.decode_edges(e_data)
+
+    def dump_features(self, ftrs, version=None):
+        if (self.version if version is None else version) == self.PICKLE:
+            return self.serialize(ftrs)
+        return codec.encode_features(ftrs)
+
+    def load_features(self, f_data):
+        if self.version == self.PICKLE:
+            return self.deserialize(f_data)
+        return codec.decode_features(f_data)
+
+    def graph_join(self):
+        """ Columns and join clause for pdf_id, v_md5, e_md5, vertices, edges, features of results r
+        """
+        if self.version == self.PICKLE:
+            return "r.pdf_id, r.v_md5, r.e_md5, r.vertices, r.edges, r.features", ''
+        return "r.pdf_id, r.v_md5, r.e_md5, v.data, e.data, r.features", \
+               "left join %s v on v.v_md5 = r.v_md5 left join %s e on e.e_md5 = r.e_md5" % \
+               (self.vertex_table, self.edge_table)
+
+    def select_graphs(self, where):
+        cols, join = self.graph_join()
+        return "select %s from %s r %s %s" % (cols, self.table, join, where)
+
+    def save_blobs(self, v_md5, e_md5, v_set, e_set):
+        """ Store the vertices and edges payloads, once per hash
+        """
+        self.write("insert or ignore into %s values(?, ?)" % self.vertex_table, (v_md5, codec.encode_vertices(v_set)))
+        self.write("insert or ignore into %s values(?, ?)" % self.edge_table, (e_md5, codec.encode_edges(e_set)))
+
     def save(self, pdf, v_md5, e_md5, v_set, e_set, ftrs):
         cmd = "insert or replace into %s values(?, ?, ?, ?, ?, ?)" % self.table
-        v_json = self.serialize(v_set)
-        e_json = self.serialize(e_set)
-        f_json = self.serialize(ftrs)
-        rv = self.query(cmd, (pdf, v_md5, e_md5, v_json, e_json, f_json))
+        f_data = self.dump_features(ftrs)
+        if self.version == self.PICKLE:
+            v_data, e_data = self.serialize(v_set), self.serialize(e_set)
+        else:
+            self.save_blobs(v_md5, e_md5, v_set, e_set)
+            v_data, e_data = None, None
+        rv = self.write(cmd, (pdf, v_md5, e_md5, v_data, e_data, f_data))
         return rv
 
+    def migrate(self, chunk=500):
+        """ Rewrite every row in the codec.VERSION format, in one transaction
+
+        :return: number of rows rewritten
+        :rtype: int
+        """
+        if self.version == codec.VERSION:
+            return 0
+        cmd = "update %s set vertices=null, edges=null, features=? where rowid=?" % self.table
+        select = "select rowid, v_md5, e_md5, vertices, edges, features from %s where rowid > ? order by rowid limit %d" \
+                 % (self.table, chunk)
+        count = 0
+        last = -1
+        stored = set()
+        # Manage the transaction by hand, so the user_version pragma commits with the rows
+        self.conn.isolation_level = None
+        try:
+            self.conn.execute("begin")
+            while True:
+                rows = self.conn.execute(select, (last,)).fetchall()
+                if not rows:
+                    break
+                updates = []
+                for rowid, v_md5, e_md5, v_data, e_data, f_data in rows:
+                    if (v_md5, e_md5) not in stored:
+                        v_set, e_set = self.load_graph(v_data, e_data)
+                        self.conn.execute("insert or ignore into %s values(?, ?)" % self.vertex_table,
+                                          (v_md5, codec.encode_vertices(v_set)))
+                        self.conn.execute("insert or ignore into %s values(?, ?)" % self.edge_table,
+                                          (e_md5, codec.encode_edges(e_set)))
+                        stored.add((v_md5, e_md5))
+                    updates.append((self.dump_features(self.load_features(f_data), codec.VERSION), rowid))
+                self.conn.executemany(cmd, updates)
+                count += len(rows)
+                last = rows[-1][0]
+                logging.debug("GraphDb.migrate %d rows" % count)
+            self.conn.execute("pragma user_version=%d" % codec.VERSION)
+            self.conn.execute("commit")
+            self.version = codec.VERSION
+        except sqlite3.Error as e:
+            logging.error("GraphDb.migrate error (%s): %s" % (self.dbpath, e))
+            try:
+                self.conn.execute("rollback")
+            except sqlite3.Error:
+                pass
+            return -1
+        finally:
+            self.conn.isolation_level = ''
+        return count
+
+    def compact(self):
+        """ Migrate to the current format, drop payloads no row references and vacuum
+
+        :return: number of rows migrated, -1 on error
+        :rtype: int
+        """
+        count = self.migrate()
+        if count < 0:
+            return count
+        try:
+            with self.conn:
+                for table, col in ((self.vertex_table, 'v_md5'), (self.edge_table, 'e_md5')):
+                    cur = self.conn.execute("delete from %s where %s not in (select %s from %s)" %
+                                            (table, col, col, self.table))
+                    logging.info("GraphDb.compact dropped %d unused %s" % (cur.rowcount, table))
+            self.conn.isolation_level = None
+            self.conn.execute("vacuum")
+        except sqlite3.Error as e:
+            logging.error("GraphDb.compact error (%s): %s" % (self.dbpath, e))
+            return -1
+        finally:
+            self.conn.isolation_level = ''
+        return count
+
+    def save_content(self, content_md5, pdf):
+        """ Map the md5 of a sample's bytes to its row, replacing whatever pdf's row held before
+        """
+        self.write("delete from %s where pdf_id=?" % self.content_table, (pdf,))
+        cmd = "insert or replace into %s values(?, ?)" % self.content_table
+        return self.write(cmd, (content_md5, pdf))
+
+    def lookup_content(self, content_md5):
+        cmd = "select c.pdf_id from %s c join %s r on r.pdf_id = c.pdf_id where c.content_md5=?" % \
+              (self.content_table, self.table)
+        rows = self.query(cmd, (content_md5,))
+        if rows:
+            return rows[0][0]
+        return ''
+
+    def copy_pdf(self, src, dst):
+        """ Save the row of pdf src again as pdf dst
+        """
+        if src == dst:
+            return []
+        self.write("delete from %s where pdf_id=?" % self.content_table, (dst,))
+        cmd = "insert or replace into %s select ?, v_md5, e_md5, vertices, edges, features from %s where pdf_id=?" % \
+              (self.table, self.table)
+        return self.write(cmd, (dst, src))
+
     def load_family_features(self, edge_md5):
-        cmd = "select pdf_id, features from %s where e_md5=? limit 1" % self.table
+        cmd = "select pdf_id, features from %s where e_md5=?" % self.family_table
         rows = self.query(cmd, (edge_md5,))
         if rows:
             pdf_id, f_json = rows[0]
-            f_list = self.deserialize(f_json)
+            f_list = self.load_features(f_json)
         else:
             pdf_id, f_list = '', ''
         return pdf_id, f_list
 
+    def iter_families(self, batch=500):
+        """ Stream (e_md5, pdf_id, features) of every family
+        """
+        for e_md5, pdf_id, f_data in self.stream("e_md5, pdf_id, features", self.family_table, batch=batch):
+            yield e_md5, pdf_id, self.load_features(f_data)
+
+    def family_ids(self):
+        """ (e_md5, pdf_id) of every family, without features
+        """
+        return self.query("select e_md5, pdf_id from %s" % self.family_table, ())
+
+    def count_families(self):
+        rows = self.query("select count(*) from %s" % self.family_table, ())
+        if rows:
+            return rows[0][0]
+        return -1
+
     def load_pdf_graph(self, pdf):
-        cmd = "select pdf_id, v_md5, e_md5, vertices, edges, features from %s where pdf_id=?" % self.table
+        cmd = self.select_graphs("where pdf_id=?")
         rows = self.query(cmd, (pdf,))
         if rows:
             graph_md5, v_md5, e_md5, v_json, e_json, f_json = rows[0]
-            v_set = self.deserialize(v_json)
-            e_set = self.deserialize(e_json)
-            f_list = self.deserialize(f_json)
+            v_set, e_set = self.load_graph(v_json, e_json)
+            f_list = self.load_features(f_json)
             return graph_md5, v_md5, e_md5, v_set, e_set, f_list
         else:
             logging.debug("PDF not found: %s" % pdf)
             return ['' for i in range(6)]
 
     def chunk(self, limit, offset):
-        cmd = "select pdf_id, vertices, edges from %s limit %d offset %d" % (self.table, limit, offset)
+        """ Deprecated, every call scans offset rows. Use stream
+        """
+        cmd = self.select_graphs("limit %d offset %d" % (limit, offset))
         rows = self.query(cmd, ())
-        for idx, (pdf, v, e) in enumerate(rows):
-            rows[idx] = [pdf, self.deserialize(v), self.deserialize(e)]
+        for idx, (pdf, v_md5, e_md5, v, e, f) in enumerate(rows):
+            rows[idx] = [pdf] + list(self.load_graph(v, e))
+        return rows
+
+def shard_path(dbpath, idx):
+    root, ext = os.path.splitext(dbpath)
+    return "%s-%02d%s" % (root, idx, ext)
+
+
+class ShardWriters(object):
+    """ The writers of every shard of a ShardedGraphDb, as one with block
+    """
+
+    def __init__(self, writers):
+        self.writers = writers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def depth(self):
+        return sum(writer.depth() for writer in self.writers)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class ShardedGraphDb(object):
+    """ GraphDb split over shards files, routed by the md5 of pdf_id
+
+    <root>-00<ext> .. <root>-NN<ext> beside dbpath each hold the rows of the pdfs
+    that hash to them, so every shard has its own writer and can be vacuumed or
+    copied on its own. Per pdf calls go to one shard. Lookups by e_md5 or content
+    fan out, and families seen in more than one shard are reported once, from the
+    first shard that has them. An attached db, such as the job db, is attached to
+    every shard.
+    """
+
+    def __init__(self, dbpath, shards, wal=False, synchronous=None):
+        self.dbpath = dbpath
+        self.paths = [shard_path(dbpath, idx) for idx in range(shards)]
+        self.shards = [GraphDb(path, wal, synchronous) for path in self.paths]
+        self.table = GraphDb.table
+        self.cols = GraphDb.cols
+
+    def attach_db(self, path, alias):
+        return all(shard.attach_db(path, alias) for shard in self.shards)
+
+    def sidecar(self, ext):
+        """ <root>-00-NN<ext> plus ext, named after the shard set so that a sharded and
+        an unsharded db at the same path keep files of their own
+        """
+        root, db_ext = os.path.splitext(self.dbpath)
+        return "%s-00-%02d%s%s" % (root, len(self.paths) - 1, db_ext, ext)
+
+    def init(self, table, cols):
+        have = [os.path.exists(path) for path in self.paths]
+        if any(have) and not all(have) or os.path.exists(shard_path(self.dbpath, len(self.paths))):
+            logging.error("ShardedGraphDb.init %s was built with a different number of shards" % self.dbpath)
+            return False
+        if not any(have) and os.path.exists(self.dbpath):
+            logging.error("ShardedGraphDb.init %s was built without --shards" % self.dbpath)
+            return False
+        return all(shard.init(table, cols) for shard in self.shards)
+
+    def shard(self, pdf):
+        return self.shards[int(hashlib.md5(pdf).hexdigest()[:8], 16) % len(self.shards)]
+
+    def batch(self, size=1000, interval=5.0, queue=0):
+        return ShardWriters([shard.batch(size, interval, queue) for shard in self.shards])
+
+    def size(self):
+        return sum(shard.size() for shard in self.shards)
+
+    def get_unique(self, field):
+        seen = set()
+        for shard in self.shards:
+            seen.update(row[0] for row in shard.get_unique(field))
+        return [(value,) for value in seen]
+
+    def save(self, pdf, v_md5, e_md5, v_set, e_set, ftrs):
+        return self.shard(pdf).save(pdf, v_md5, e_md5, v_set, e_set, ftrs)
+
+    def save_content(self, content_md5, pdf):
+        return self.shard(pdf).save_content(content_md5, pdf)
+
+    def lookup_content(self, content_md5):
+        for shard in self.shards:
+            pdf_id = shard.lookup_content(content_md5)
+            if pdf_id:
+                return pdf_id
+        return ''
+
+    def copy_pdf(self, src, dst):
+        src_shard, dst_shard = self.shard(src), self.shard(dst)
+        if src_shard is dst_shard:
+            return src_shard.copy_pdf(src, dst)
+        # src may still be pending in its shard's writer
+        if src_shard.writer:
+            src_shard.writer.flush()
+        name, v_md5, e_md5, v_set, e_set, ftrs = src_shard.load_pdf_graph(src)
+        if not name:
+            return []
+        return dst_shard.save(dst, v_md5, e_md5, v_set, e_set, ftrs)
+
+    def load_pdf_graph(self, pdf):
+        return self.shard(pdf).load_pdf_graph(pdf)
+
+    def load_family_features(self, edge_md5):
+        for shard in self.shards:
+            pdf_id, ftrs = shard.load_family_features(edge_md5)
+            if pdf_id:
+                return pdf_id, ftrs
+        return '', ''
+
+    def iter_families(self, batch=500):
+        seen = set()
+        for shard in self.shards:
+            for e_md5, pdf_id, ftrs in shard.iter_families(batch):
+                if e_md5 not in seen:
+                    seen.add(e_md5)
+                    yield e_md5, pdf_id, ftrs
+
+    def family_ids(self):
+        seen = set()
+        rows = []
+        for shard in self.shards:
+            for e_md5, pdf_id in shard.family_ids():
+                if e_md5 not in seen:
+                    seen.add(e_md5)
+                    rows.append((e_md5, pdf_id))
         return rows
 
+    def count_families(self):
+        return len(self.family_ids())
+
+    def migrate(self):
+        counts = [shard.migrate() for shard in self.shards]
+        return -1 if -1 in counts else sum(counts)
+
+    def compact(self):
+        counts = [shard.compact() for shard in self.shards]
+        return -1 if -1 in counts else sum(counts)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print "Need database"
@@ -166,6 +964,5 @@ if __name__ == "__main__":
         print "Database error"
         sys.exit(1)
 
-    families = [row[0] for row in gdb.get_unique('e_md5')]
-    for f in families:
-        print "%s,%s" % gdb.load_family_features(f)
+    for e_md5, pdf_id, ftrs in gdb.iter_families():
+        print "%s,%s" % (pdf_id, list(ftrs))
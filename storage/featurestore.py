@@ -0,0 +1,159 @@
+import logging
+import os
+
+import numpy as np
+
+from index import finite
+
+
+def escape_id(field):
+    """ Field of an ids line with tabs, newlines and backslashes escaped
+    """
+    if isinstance(field, unicode):
+        field = field.encode('utf-8')
+    return str(field).encode('string_escape')
+
+
+def format_id_line(e_md5, pdf_id):
+    return "%s\t%s\n" % (escape_id(e_md5), escape_id(pdf_id))
+
+
+def parse_id_line(line):
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) != 2:
+        raise ValueError("expected e_md5<tab>pdf_id, got %r" % line)
+    return tuple(field.decode('string_escape') for field in fields)
+
+
+class FeatureStore(object):
+    """ Family features of a GraphDb as a raw float64 matrix, opened with numpy.memmap
+
+    graph_db.sidecar('.ftr') holds one row of width little endian float64s per family
+    and <that>.ids the matching "e_md5<tab>pdf_id" lines, with tabs, newlines and
+    backslashes in either field escaped as in python strings. Processes that map the
+    file share its pages through the page cache instead of each loading the
+    features from sqlite. New families are appended, the files are only rewritten
+    when a family they hold has gone from the graph db.
+    """
+
+    ext = '.ftr'
+    id_ext = '.ids'
+    dtype = np.dtype('<f8')
+
+    def __init__(self, path, width=35):
+        self.path = path
+        self.id_path = path + self.id_ext
+        self.width = width
+        self.ids = []
+        self.families = set()
+        self.pending = []
+
+    @classmethod
+    def for_db(cls, graph_db, width=35):
+        return cls(graph_db.sidecar(cls.ext), width)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def row_bytes(self):
+        return self.width * self.dtype.itemsize
+
+    def load(self):
+        if not os.path.isfile(self.path) or not os.path.isfile(self.id_path):
+            self.clear()
+            return False
+        try:
+            with open(self.id_path, 'r') as fin:
+                ids = [parse_id_line(line) for line in fin if line.endswith('\n')]
+            rows = min(len(ids), os.path.getsize(self.path) // self.row_bytes)
+            if rows != len(ids) or rows * self.row_bytes != os.path.getsize(self.path):
+                # An append was cut short, drop the partial rows
+                logging.warning("FeatureStore.load truncating %s to %d rows" % (self.path, rows))
+                self.truncate(rows, ids)
+        except (IOError, OSError) as e:
+            logging.error("FeatureStore.load error (%s): %s" % (self.path, e))
+            return False
+        except ValueError as e:
+            # A badly escaped ids line, the rows can not be matched to families
+            logging.error("FeatureStore.load error (%s): %s" % (self.id_path, e))
+            self.clear()
+            return False
+        self.ids = ids[:rows]
+        self.families = set(e_md5 for e_md5, pdf_id in self.ids)
+        return True
+
+    def truncate(self, rows, ids):
+        with open(self.path, 'r+b') as fout:
+            fout.truncate(rows * self.row_bytes)
+        with open(self.id_path, 'w') as fout:
+            fout.writelines(format_id_line(*row) for row in ids[:rows])
+
+    def matrix(self):
+        """ Read only memmap of every row, in the order of ids
+        """
+        if not self.ids:
+            return np.empty((0, self.width), dtype=self.dtype)
+        return np.memmap(self.path, dtype=self.dtype, mode='r', shape=(len(self.ids), self.width))
+
+    def add(self, e_md5, pdf_id, ftrs):
+        if e_md5 in self.families:
+            return False
+        if not finite(ftrs) or len(ftrs) != self.width:
+            logging.warning("FeatureStore.add skipping bad features for %s (%s)" % (pdf_id, e_md5))
+            return False
+        self.families.add(e_md5)
+        self.pending.append((e_md5, pdf_id, ftrs))
+        return True
+
+    def flush(self):
+        """ Append pending rows, features before ids so a torn append is dropped by load
+        """
+        if not self.pending:
+            return True
+        rows = np.array([ftrs for e_md5, pdf_id, ftrs in self.pending], dtype=self.dtype)
+        try:
+            with open(self.path, 'ab') as fout:
+                fout.write(rows.tostring())
+            with open(self.id_path, 'a') as fout:
+                fout.writelines(format_id_line(e_md5, pdf_id) for e_md5, pdf_id, ftrs in self.pending)
+        except (IOError, OSError) as e:
+            logging.error("FeatureStore.flush error (%s): %s" % (self.path, e))
+            self.load()
+            self.pending = []
+            return False
+        self.ids.extend((e_md5, pdf_id) for e_md5, pdf_id, ftrs in self.pending)
+        self.pending = []
+        return True
+
+    def clear(self):
+        for path in (self.path, self.id_path):
+            if os.path.exists(path):
+                os.unlink(path)
+        self.ids = []
+        self.families = set()
+        self.pending = []
+
+    def sync(self, graph_db, rebuild=False):
+        """ Append the families of graph_db that are missing from the store
+
+        :return: number of families appended
+        :rtype: int
+        """
+        self.load()
+        current = graph_db.family_ids()
+        if rebuild or self.families - set(e_md5 for e_md5, pdf_id in current):
+            self.clear()
+        missing = len([e_md5 for e_md5, pdf_id in current if e_md5 not in self.families])
+        if not missing:
+            return 0
+        logging.info("FeatureStore.sync adding %d families" % missing)
+        if missing < len(current) / 2:
+            for e_md5, pdf_id in current:
+                if e_md5 not in self.families:
+                    self.add(e_md5, *graph_db.load_family_features(e_md5))
+        else:
+            for e_md5, pdf_id, ftrs in graph_db.iter_families():
+                self.add(e_md5, pdf_id, ftrs)
+        self.flush()
+        return missing
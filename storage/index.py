@@ -0,0 +1,266 @@
+import cPickle
+import heapq
+import logging
+import math
+import os
+import random
+
+from scipy.spatial.distance import canberra
+
+
+def finite(ftrs):
+    try:
+        return len(ftrs) > 0 and all(not math.isnan(f) and not math.isinf(f) for f in ftrs)
+    except TypeError:
+        return False
+
+
+class VPTree(object):
+    """ Vantage point tree over feature vectors
+
+    Canberra distance is a metric, so whole subtrees can be pruned with the triangle
+    inequality. Nodes are kept in a flat list, [vantage, mu, inside, outside, bucket],
+    so that deep trees pickle without recursion. Leaves have a vantage of -1 and keep
+    their points in bucket.
+    """
+
+    leaf_size = 16
+
+    def __init__(self, dist=canberra):
+        self.dist = dist
+        self.keys = []
+        self.points = []
+        self.nodes = []
+        self.root = -1
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['dist']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.dist = canberra
+
+    def new_node(self, bucket):
+        self.nodes.append([-1, 0.0, -1, -1, bucket])
+        return len(self.nodes) - 1
+
+    def split(self, node_id):
+        """ Turn the leaf node_id into a subtree, splitting buckets until they fit a leaf
+        """
+        todo = [node_id]
+        while todo:
+            node = self.nodes[todo.pop()]
+            bucket = node[4]
+            if len(bucket) <= self.leaf_size:
+                continue
+            vp = bucket.pop(random.randrange(len(bucket)))
+            dists = [self.dist(self.points[vp], self.points[idx]) for idx in bucket]
+            ordered = sorted(dists)
+            mu = ordered[len(ordered) / 2]
+            if mu == ordered[0]:
+                # Duplicate vectors pile up at the median, split them off by themselves
+                mu = next((d for d in ordered if d > ordered[0]), None)
+                if mu is None:
+                    bucket.append(vp)
+                    continue
+            inside = [idx for idx, d in zip(bucket, dists) if d < mu]
+            outside = [idx for idx, d in zip(bucket, dists) if d >= mu]
+            node[0], node[1], node[4] = vp, mu, None
+            node[2] = self.new_node(inside)
+            node[3] = self.new_node(outside)
+            todo.extend([node[2], node[3]])
+
+    def build(self, keys, points):
+        self.keys = list(keys)
+        self.points = list(points)
+        self.nodes = []
+        self.root = self.new_node(range(len(self.points)))
+        self.split(self.root)
+
+    def insert(self, key, point):
+        idx = len(self.points)
+        self.keys.append(key)
+        self.points.append(point)
+        if self.root < 0:
+            self.root = self.new_node([idx])
+            return
+        node_id = self.root
+        node = self.nodes[node_id]
+        while node[0] >= 0:
+            if self.dist(point, self.points[node[0]]) < node[1]:
+                node_id = node[2]
+            else:
+                node_id = node[3]
+            node = self.nodes[node_id]
+        node[4].append(idx)
+        if len(node[4]) > 2 * self.leaf_size:
+            self.split(node_id)
+
+    def range(self, q, radius):
+        """ All (distance, key) pairs within radius of q
+        """
+        found = []
+        todo = [self.root] if self.root >= 0 else []
+        while todo:
+            vp, mu, inside, outside, bucket = self.nodes[todo.pop()]
+            if vp < 0:
+                for idx in bucket:
+                    d = self.dist(q, self.points[idx])
+                    if d <= radius:
+                        found.append((d, self.keys[idx]))
+                continue
+            d = self.dist(q, self.points[vp])
+            if d <= radius:
+                found.append((d, self.keys[vp]))
+            if d - radius < mu:
+                todo.append(inside)
+            if d + radius >= mu:
+                todo.append(outside)
+        found.sort()
+        return found
+
+    def knn(self, q, k, radius=float('inf')):
+        """ The k nearest (distance, key) pairs to q, optionally bounded by radius
+        """
+        best = []
+        todo = [(0.0, self.root)] if self.root >= 0 else []
+
+        def tau():
+            return -best[0][0] if len(best) == k else radius
+
+        def visit(idx, d):
+            if d > radius:
+                return
+            if len(best) < k:
+                heapq.heappush(best, (-d, idx))
+            elif d < -best[0][0]:
+                heapq.heapreplace(best, (-d, idx))
+
+        while todo:
+            bound, node_id = heapq.heappop(todo)
+            if bound > tau():
+                break
+            vp, mu, inside, outside, bucket = self.nodes[node_id]
+            if vp < 0:
+                for idx in bucket:
+                    visit(idx, self.dist(q, self.points[idx]))
+                continue
+            d = self.dist(q, self.points[vp])
+            visit(vp, d)
+            heapq.heappush(todo, (max(bound, d - mu), inside))
+            heapq.heappush(todo, (max(bound, mu - d), outside))
+        return sorted((-d, self.keys[idx]) for d, idx in best)
+
+
+class FamilyIndex(object):
+    """ Persistent metric index of GraphDb families, keyed by (e_md5, pdf_id)
+
+    The index lives beside the graph database, at graph_db.sidecar('.vpt'), and is
+    brought up to date with sync() or insert() as new families are saved.
+    """
+
+    ext = '.vpt'
+
+    def __init__(self, path, width=35):
+        self.path = path
+        self.width = width
+        self.tree = VPTree()
+        self.families = set()
+        self.dirty = False
+
+    @classmethod
+    def for_db(cls, graph_db, width=35):
+        return cls(graph_db.sidecar(cls.ext), width)
+
+    def __len__(self):
+        return len(self.families)
+
+    def valid(self, ftrs):
+        return finite(ftrs) and len(ftrs) == self.width
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, 'rb') as fin:
+                self.tree = cPickle.load(fin)
+        except (IOError, EOFError, cPickle.UnpicklingError) as e:
+            logging.error("FamilyIndex.load error (%s): %s" % (self.path, e))
+            self.tree = VPTree()
+            return False
+        self.families = set(e_md5 for e_md5, pdf_id in self.tree.keys)
+        return True
+
+    def save(self):
+        if not self.dirty:
+            return True
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as fout:
+                cPickle.dump(self.tree, fout, protocol=2)
+            os.rename(tmp, self.path)
+        except (IOError, OSError, cPickle.PicklingError) as e:
+            logging.error("FamilyIndex.save error (%s): %s" % (self.path, e))
+            return False
+        self.dirty = False
+        return True
+
+    def insert(self, e_md5, pdf_id, ftrs):
+        if e_md5 in self.families:
+            return False
+        if not self.valid(ftrs):
+            logging.warning("FamilyIndex.insert skipping bad features for %s" % pdf_id)
+            return False
+        self.families.add(e_md5)
+        self.tree.insert((e_md5, pdf_id), list(ftrs))
+        self.dirty = True
+        return True
+
+    def sync(self, graph_db, rebuild=False):
+        """ Add any families in graph_db that are missing from the index
+
+        The tree can not drop points, so an index holding families that are gone from
+        graph_db, after compact or deleted rows, is rebuilt. An empty index, or rebuild,
+        bulk loads a balanced tree instead of inserting.
+        """
+        current = graph_db.family_ids()
+        stale = self.families - set(e_md5 for e_md5, pdf_id in current)
+        if stale:
+            logging.info("FamilyIndex.sync %d families are gone, rebuilding" % len(stale))
+        if rebuild or stale:
+            self.tree = VPTree()
+            self.families = set()
+            self.dirty = True
+        missing = set(e_md5 for e_md5, pdf_id in current if e_md5 not in self.families)
+        if not missing:
+            return 0
+        logging.info("FamilyIndex.sync indexing %d families" % len(missing))
+        # Only the features of missing families are loaded, a few at a time or in one pass
+        if len(missing) < len(current) / 2:
+            rows = [(e_md5,) + tuple(graph_db.load_family_features(e_md5)) for e_md5 in missing]
+        else:
+            rows = [row for row in graph_db.iter_families() if row[0] in missing]
+        if len(self.tree):
+            for e_md5, pdf_id, ftrs in rows:
+                self.insert(e_md5, pdf_id, ftrs)
+        else:
+            keys, points = [], []
+            for e_md5, pdf_id, ftrs in rows:
+                if self.valid(ftrs):
+                    keys.append((e_md5, pdf_id))
+                    points.append(list(ftrs))
+                    self.families.add(e_md5)
+            self.tree.build(keys, points)
+            self.dirty = True
+        return len(missing)
+
+    def range(self, ftrs, radius):
+        return self.tree.range(ftrs, radius)
+
+    def knn(self, ftrs, k, radius=float('inf')):
+        return self.tree.knn(ftrs, k, radius)
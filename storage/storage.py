@@ -1,6 +1,10 @@
 import json
 import psycopg2
+import sqlite3
 import sys
+import time
+import zlib
+from cStringIO import StringIO
 
 from db_mgmt import DBGateway
 
@@ -28,16 +32,29 @@ COLUMNS = ('category',
         'urls',
         'malformed',
         'errors')
+LARGE_COLUMNS = ('tree', 'graph', 'swf', 'abc', 'actionscript', 'bin_blob')
+
+
+def decompress(value):
+    """ Value of a DbStorage column as stored, whether or not it was compressed
+    """
+    if isinstance(value, buffer):
+        try:
+            return zlib.decompress(value)
+        except zlib.error:
+            return str(value)
+    return value
+
 
 class StorageFactory(object):
 
-    def new_storage(self, typ, name='500k-test', user='honey'):
+    def new_storage(self, typ, name='500k-test', user='honey', batch=0, compress=()):
         if typ == 'stdout':
             return StdoutStorage()
         if typ == 'sqlite3':
-            return DbStorage(name)
+            return DbStorage(name, batch, compress)
         if typ == 'postgres':
-            return PostgresStorage(name, user)
+            return PostgresStorage(name, user, batch=batch)
         if typ == 'neo4j':
             return NeoStorage()
         if typ == 'file':
@@ -62,19 +79,26 @@ class Storage(object):
 
 
 class PostgresStorage(Storage):
+    """ With batch set, rows are buffered and sent with one COPY per batch. A batch that
+    fails is rolled back and inserted again row by row, so only the bad rows are lost
+    """
 
     insert = "INSERT INTO parsed_pdfs (%s) VALUES (%s)"
     create = "CREATE TABLE IF NOT EXISTS parsed_pdfs (rowid serial, %s TEXT, PRIMARY KEY (rowid, pdf_md5))"
+    copy = "COPY parsed_pdfs (%s) FROM STDIN"
 
-    def __init__(self, dbname, user, pw = ''):
+    def __init__(self, dbname, user, pw = '', batch=0):
         self.dbname = dbname
         self.user = user
         self.pw = pw
+        self.batch = batch
+        self.pending = []
         ccols = ' TEXT, '.join(COLUMNS)
         icols = ', '.join(COLUMNS)
         markers = ', '.join(['%s' for x in COLUMNS])
         self.create = self.create % (ccols)
         self.insert = self.insert % (icols, markers)
+        self.copy = self.copy % (icols)
 
     def open(self):
         try:
@@ -92,16 +116,71 @@ class PostgresStorage(Storage):
 
     def store(self, data_dict):
         data_tuple = self.align_kwargs(data_dict)
+        if self.batch:
+            self.pending.append(data_tuple)
+            if len(self.pending) >= self.batch:
+                self.flush()
+            return
         try:
             cur = self.conn.cursor()
             cur.execute(self.insert, data_tuple)
         except Exception as e:
             self.conn.rollback()
+            sys.stderr.write("Postgres Store Error\t%s\t%s\n" % (data_dict.get('pdf_md5'), str(e)))
         else:
             self.conn.commit()
             cur.close()
 
+    @staticmethod
+    def copy_field(value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def flush(self):
+        """ COPY the pending rows in one transaction, falling back to row by row inserts
+        """
+        if not self.pending:
+            return 0
+        rows, self.pending = self.pending, []
+        buf = StringIO()
+        for row in rows:
+            buf.write('\t'.join(self.copy_field(value) for value in row))
+            buf.write('\n')
+        buf.seek(0)
+        try:
+            cur = self.conn.cursor()
+            cur.copy_expert(self.copy, buf)
+            self.conn.commit()
+            cur.close()
+            return len(rows)
+        except Exception as e:
+            self.conn.rollback()
+            sys.stderr.write("Postgres Copy Error, retrying %d rows one at a time\t%s\n" % (len(rows), str(e)))
+        return self.insert_rows(rows)
+
+    def insert_rows(self, rows):
+        """ Insert rows in one transaction, a savepoint around each so a bad row only drops itself
+        """
+        stored = 0
+        cur = self.conn.cursor()
+        for row in rows:
+            try:
+                cur.execute("SAVEPOINT store_row")
+                cur.execute(self.insert, row)
+                cur.execute("RELEASE SAVEPOINT store_row")
+                stored += 1
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT store_row")
+                sys.stderr.write("Postgres Store Error\t%s\t%s\n" % (row[COLUMNS.index(PRIMARY)], str(e)))
+        self.conn.commit()
+        cur.close()
+        return stored
+
     def close(self):
+        self.flush()
         self.conn.commit()
         self.conn.close()
 
@@ -114,14 +193,28 @@ class StdoutStorage(Storage):
 
 
 class DbStorage(Storage):
-
-
-    def __init__(self, db=''):
-        self.db = DBGateway(db + '.sqlite')
+    """ With batch or compress set, rows are inserted batch at a time in one transaction
+    each, and the columns named in compress (see LARGE_COLUMNS) are stored as zlib
+    blobs. Read them back with load(), or decompress() for rows queried elsewhere.
+    """
+
+    insert = "INSERT INTO %s (%s) VALUES (%s)" % (TABLE, ', '.join(COLUMNS), ', '.join('?' for col in COLUMNS))
+    insert_error = "INSERT INTO %s (pdf_md5, errors) VALUES (?, ?)" % TABLE
+
+    def __init__(self, db='', batch=0, compress=()):
+        self.path = db + '.sqlite'
+        self.db = DBGateway(self.path)
+        self.batch = batch
+        self.compress = [COLUMNS.index(col) for col in compress]
+        self.pending = []
+        self.conn = None
 
     def open(self):
         try:
             self.db.create_table(TABLE, cols=[ ' '.join([col, 'TEXT']) for col in COLUMNS], primary=PRIMARY)
+            if self.batch or self.compress:
+                self.conn = sqlite3.connect(self.path)
+                self.conn.text_factory = str
         except Exception:
             return False
         else:
@@ -129,14 +222,75 @@ class DbStorage(Storage):
 
     def store(self, data_dict):
         data_tuple = self.align_kwargs(data_dict)
+        if self.conn:
+            self.pending.append(self.pack(data_tuple))
+            if len(self.pending) >= max(self.batch, 1):
+                self.flush()
+            return
         if not self.db.insert(TABLE, cols=COLUMNS, vals=data_tuple):
             err_tuple = (data_dict.get('pdf_md5'), 'DB_ERROR: %s' % self.db.get_error())
             self.db.insert(TABLE, cols=['pdf_md5', 'errors'], vals=err_tuple)
 
+    def pack(self, data_tuple):
+        row = list(data_tuple)
+        for idx in self.compress:
+            value = row[idx]
+            if value:
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                row[idx] = sqlite3.Binary(zlib.compress(str(value)))
+        return tuple(row)
+
+    def flush(self):
+        """ Insert the pending rows in one transaction, or one at a time if that fails
+        """
+        rows, self.pending = self.pending, []
+        if not rows:
+            return
+        try:
+            with self.conn:
+                self.conn.executemany(self.insert, rows)
+            return
+        except sqlite3.Error:
+            pass
+        pdf_md5 = COLUMNS.index(PRIMARY)
+        for row in rows:
+            try:
+                with self.conn:
+                    self.conn.execute(self.insert, row)
+            except sqlite3.Error as e:
+                try:
+                    with self.conn:
+                        self.conn.execute(self.insert_error, (row[pdf_md5], 'DB_ERROR: %s' % e))
+                except sqlite3.Error:
+                    sys.stderr.write("DbStorage store error\t%s\t%s\n" % (row[pdf_md5], e))
+
+    def load(self, pdf_md5):
+        """ Stored columns of pdf_md5 as a dict, decompressed
+        """
+        if self.pending:
+            self.flush()
+        conn = self.conn or sqlite3.connect(self.path)
+        conn.text_factory = str
+        try:
+            row = conn.execute("SELECT %s FROM %s WHERE %s = ?" % (', '.join(COLUMNS), TABLE, PRIMARY),
+                               (pdf_md5,)).fetchone()
+        finally:
+            if conn is not self.conn:
+                conn.close()
+        if not row:
+            return {}
+        return dict(zip(COLUMNS, [decompress(value) for value in row]))
+
     def close(self):
+        if self.conn:
+            self.flush()
+            self.conn.close()
         self.db.disconnect()
 
     def contains(self, key, val):
+        if self.pending:
+            self.flush()
         return self.db.count(TABLE, key, val)
 
 
@@ -180,7 +334,33 @@ class FileStorage(Storage):
     def close(self):
         self.fd.close()
 
+def benchmark_postgres(dbname, user, rows=20000, batches=(0, 100, 1000, 5000)):
+    """ Rows per second stored into a local postgres, one insert per row vs COPY batches
+
+    Rows are tagged with category 'benchmark' and deleted afterwards.
+    """
+    blob = 'x' * 2048
+    for batch in batches:
+        storage = PostgresStorage(dbname, user, batch=batch)
+        if not storage.open():
+            return
+        start = time.time()
+        for idx in xrange(rows):
+            storage.store({'category': 'benchmark', 'pdf_md5': '%032x' % idx, 'tree': blob, 'errors': 'a\tb\nc\\'})
+        storage.flush()
+        elapsed = time.time() - start
+        cur = storage.conn.cursor()
+        cur.execute("DELETE FROM parsed_pdfs WHERE category = 'benchmark'")
+        storage.close()
+        print "batch %5d\t%8d rows\t%8.2f s\t%10.0f rows/s" % (batch, rows, elapsed, rows / elapsed)
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['benchmark']:
+        # storage.py benchmark [dbname] [user] [rows]
+        args = sys.argv[2:] + ['500k-test', 'honey', '20000'][len(sys.argv[2:]):]
+        benchmark_postgres(args[0], args[1], int(args[2]))
+        sys.exit(0)
     tests = ['test.test', 'db', 'pg', 'neo4j']
     for test in tests:
         storage = StorageFactory().new_storage(test, "500k-test")
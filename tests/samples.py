@@ -0,0 +1,40 @@
+""" Small pdfs written on the fly, so the tests need no sample files
+"""
+import os
+
+CATALOG = [
+    "<< /Type /Catalog /Pages 2 0 R /OpenAction 4 0 R >>",
+    "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+    "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << >> >>",
+    "<< /S /JavaScript /JS (app.alert\\(1\\);) /Next 5 0 R >>",
+    "<< /S /URI /URI (http://example.com/) >>",
+]
+
+
+def pdf_bytes(objects=CATALOG, trailer=''):
+    """ A pdf with one indirect object per entry of objects and a valid xref table
+    """
+    body = "%PDF-1.4\n"
+    offsets = []
+    for objid, obj in enumerate(objects, 1):
+        offsets.append(len(body))
+        body += "%d 0 obj\n%s\nendobj\n" % (objid, obj)
+    xref = len(body)
+    body += "xref\n0 %d\n0000000000 65535 f\r\n" % (len(objects) + 1)
+    body += ''.join("%010d 00000 n\r\n" % pos for pos in offsets)
+    body += "trailer\n<< /Size %d /Root 1 0 R %s>>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, trailer, xref)
+    return body
+
+
+def write_pdf(dirname, name, objects=CATALOG, trailer=''):
+    path = os.path.join(dirname, name)
+    with open(path, 'wb') as fout:
+        fout.write(pdf_bytes(objects, trailer))
+    return path
+
+
+def write_bad_pdf(dirname, name):
+    """ A pdf that fails to parse, its /Encrypt dict names a filter pdfminer does not know
+    """
+    return write_pdf(dirname, name, CATALOG + ["<< /Filter /Bogus >>"],
+                     "/Encrypt %d 0 R /ID [<00> <00>] " % (len(CATALOG) + 1))
@@ -0,0 +1,147 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import dbgw
+from storage.featurestore import FeatureStore
+from storage.index import FamilyIndex
+
+FTRS = [float(idx) for idx in range(35)]
+
+
+class TestShardedGraphDb(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.dirname = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.dirname, 'graphdb.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+        logging.disable(logging.NOTSET)
+
+    def open_db(self, shards):
+        if shards > 1:
+            graph_db = dbgw.ShardedGraphDb(self.dbpath, shards)
+        else:
+            graph_db = dbgw.GraphDb(self.dbpath)
+        ok = graph_db.init(graph_db.table, graph_db.cols)
+        return graph_db if ok else None
+
+    def test_job_marks_commit_with_shard(self):
+        graph_db = self.open_db(3)
+        job_db = dbgw.JobDb(os.path.join(self.dirname, 'jobs.sqlite'))
+        self.assertTrue(job_db.init(job_db.table, job_db.cols))
+        self.assertTrue(job_db.attach(graph_db))
+
+        paths = ['/samples/%d.pdf' % idx for idx in range(30)]
+        writers = graph_db.batch(size=1000, interval=1000)
+        for path in paths:
+            name = os.path.basename(path)
+            graph_db.save(name, 'v%s' % name, 'e%s' % name, [(name, ['object'])], [], FTRS)
+            job_db.mark('job', path, job_db.COMPLETE)
+
+        # Commit only the first shard, its marks must land with its rows and no others
+        writers.writers[0].flush()
+        first = graph_db.shards[0]
+        saved = set(row[0] for row in first.query("select pdf_id from results", ()))
+        marked = set(os.path.basename(row[0]) for row in job_db.query("select sample_path from jobs", ()))
+        self.assertTrue(saved)
+        self.assertEqual(saved, marked)
+
+        writers.close()
+        self.assertEqual(job_db.get_completed('job'), set(paths))
+        graph_db.close()
+        job_db.close()
+
+    def test_copy_pdf_across_shards(self):
+        graph_db = self.open_db(3)
+        src = 'src.pdf'
+        dst = next(name for name in ('%d.pdf' % idx for idx in range(30))
+                   if graph_db.shard(name) is not graph_db.shard(src))
+        for queue in (0, 100):
+            with graph_db.batch(size=1000, interval=1000, queue=queue):
+                graph_db.save(src, 'v_md5', 'e_md5', [(src, ['object'])], [], FTRS)
+                # src is only in its shard's writer when it is copied
+                graph_db.copy_pdf(src, dst)
+            name, v_md5, e_md5, v_set, e_set, ftrs = graph_db.load_pdf_graph(dst)
+            self.assertTrue(name)
+            self.assertEqual((v_md5, e_md5, list(ftrs)), ('v_md5', 'e_md5', FTRS))
+            for shard in graph_db.shards:
+                shard.query("delete from results", ())
+        graph_db.close()
+
+    def test_migrate_pickle(self):
+        graph_db = self.open_db(1)
+        graph_db.version = graph_db.PICKLE
+        graph_db.query("pragma user_version=%d" % graph_db.PICKLE, ())
+        v, e = [('PDF', ['start']), ('1', ['object'])], [('PDF', '1')]
+        graph_db.save('a.pdf', 'v_md5', 'e_md5', v, e, FTRS)
+        graph_db.close()
+
+        graph_db = self.open_db(1)
+        self.assertEqual(graph_db.version, graph_db.PICKLE)
+        self.assertEqual(graph_db.migrate(), 1)
+        graph_db.close()
+        graph_db = self.open_db(1)
+        self.assertEqual(graph_db.version, dbgw.codec.VERSION)
+        name, v_md5, e_md5, v_set, e_set, ftrs = graph_db.load_pdf_graph('a.pdf')
+        self.assertEqual((v_set, e_set, list(ftrs)), (v, e, FTRS))
+        # Only pickled rows and the current format can be read
+        graph_db.query("pragma user_version=1", ())
+        graph_db.close()
+        self.assertIsNone(self.open_db(1))
+
+    def test_writer_drops_bad_rows_only(self):
+        graph_db = self.open_db(1)
+        job_db = dbgw.JobDb(os.path.join(self.dirname, 'jobs.sqlite'))
+        self.assertTrue(job_db.init(job_db.table, job_db.cols))
+        self.assertTrue(job_db.attach(graph_db))
+        for queue in (0, 100):
+            with graph_db.batch(size=1000, interval=1000, queue=queue) as writer:
+                for name in ('a.pdf', 'b.pdf'):
+                    graph_db.save(name, 'v', 'e', [(name, ['object'])], [], FTRS)
+                    job_db.mark('job', name, job_db.COMPLETE)
+                # a row with too few values fails the whole executemany
+                graph_db.write("insert into content values(?, ?)", ('bad',))
+            if queue:
+                self.assertEqual((writer.written, writer.failed), (8, 1))
+            self.assertEqual(len(graph_db.query("select pdf_id from results", ())), 2)
+            self.assertEqual(job_db.get_completed('job'), set(['a.pdf', 'b.pdf']))
+            graph_db.query("delete from results", ())
+            job_db.query("delete from jobs", ())
+        graph_db.close()
+        job_db.close()
+
+    def test_sidecars_follow_shard_set(self):
+        paths = set()
+        for shards in (1, 2, 4):
+            graph_db = self.open_db(shards)
+            store, family_index = FeatureStore.for_db(graph_db), FamilyIndex.for_db(graph_db)
+            self.assertEqual(os.path.dirname(store.path), self.dirname)
+            paths.update([store.path, store.id_path, family_index.path])
+            graph_db.close()
+            # Reopening with another shard count is refused, so start over at the same path
+            for name in os.listdir(self.dirname):
+                os.unlink(os.path.join(self.dirname, name))
+        self.assertEqual(len(paths), 9)
+
+    def test_shard_count_mismatch(self):
+        self.open_db(4).close()
+        for shards in (1, 2, 8):
+            self.assertIsNone(self.open_db(shards))
+        self.assertFalse(os.path.exists(self.dbpath))
+        graph_db = self.open_db(4)
+        self.assertIsNotNone(graph_db)
+        graph_db.close()
+
+    def test_unsharded_opened_with_shards(self):
+        self.open_db(1).close()
+        self.assertIsNone(self.open_db(2))
+        self.assertFalse(os.path.exists(dbgw.shard_path(self.dbpath, 0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
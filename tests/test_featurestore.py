@@ -0,0 +1,58 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from storage.featurestore import FeatureStore
+
+WIDTH = 35
+
+
+class TestFeatureStore(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, 'graphdb.sqlite.ftr')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+        logging.disable(logging.NOTSET)
+
+    def test_ids_with_separators(self):
+        names = ['plain.pdf', 'tab\there.pdf', 'new\nline.pdf', 'back\\slash\\', u'caf\xe9.pdf'.encode('utf-8')]
+        store = FeatureStore(self.path, WIDTH)
+        for idx, name in enumerate(names):
+            self.assertTrue(store.add('e%d' % idx, name, [float(idx)] * WIDTH))
+        self.assertTrue(store.flush())
+
+        reloaded = FeatureStore(self.path, WIDTH)
+        self.assertTrue(reloaded.load())
+        self.assertEqual(reloaded.ids, [('e%d' % idx, name) for idx, name in enumerate(names)])
+        self.assertEqual(reloaded.matrix()[:, 0].tolist(), [float(idx) for idx in range(len(names))])
+
+    def test_legacy_ids(self):
+        with open(self.path, 'wb') as fout:
+            fout.write(np.zeros((2, WIDTH), dtype=FeatureStore.dtype).tostring())
+        with open(self.path + FeatureStore.id_ext, 'w') as fout:
+            fout.write("e0\ta.pdf\ne1\tb.pdf\n")
+        store = FeatureStore(self.path, WIDTH)
+        self.assertTrue(store.load())
+        self.assertEqual(store.ids, [('e0', 'a.pdf'), ('e1', 'b.pdf')])
+
+    def test_corrupt_ids(self):
+        with open(self.path, 'wb') as fout:
+            fout.write(np.zeros((2, WIDTH), dtype=FeatureStore.dtype).tostring())
+        with open(self.path + FeatureStore.id_ext, 'w') as fout:
+            fout.write("e0\ta\tb.pdf\ne1\tc.pdf\n")
+        store = FeatureStore(self.path, WIDTH)
+        self.assertFalse(store.load())
+        self.assertEqual(len(store), 0)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
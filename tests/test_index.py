@@ -0,0 +1,83 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import dbgw
+from storage.index import FamilyIndex
+
+WIDTH = 35
+
+
+class TestFamilyIndex(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.dirname = tempfile.mkdtemp()
+        self.graph_db = dbgw.GraphDb(os.path.join(self.dirname, 'graphdb.sqlite'))
+        self.graph_db.init(self.graph_db.table, self.graph_db.cols)
+
+    def tearDown(self):
+        self.graph_db.close()
+        shutil.rmtree(self.dirname)
+        logging.disable(logging.NOTSET)
+
+    def save(self, idx):
+        name = '%d.pdf' % idx
+        self.graph_db.save(name, 'v%d' % idx, 'e%d' % idx, [(name, ['object'])], [], [float(idx + 1)] * WIDTH)
+
+    def found(self, family_index):
+        return set(e_md5 for dist, (e_md5, pdf_id) in family_index.range([1.0] * WIDTH, WIDTH))
+
+    def test_sync_drops_removed_families(self):
+        for idx in range(40):
+            self.save(idx)
+        family_index = FamilyIndex.for_db(self.graph_db)
+        family_index.sync(self.graph_db)
+        self.assertEqual(len(self.found(family_index)), 40)
+
+        self.graph_db.query("delete from results where pdf_id in ('3.pdf', '17.pdf')", ())
+        family_index.sync(self.graph_db)
+        found = self.found(family_index)
+        self.assertEqual(len(found), 38)
+        self.assertNotIn('e3', found)
+        self.assertNotIn('e17', found)
+        self.assertTrue(family_index.save())
+
+        reloaded = FamilyIndex.for_db(self.graph_db)
+        self.assertTrue(reloaded.load())
+        self.assertEqual(self.found(reloaded), found)
+
+    def test_sync_loads_missing_only(self):
+        for idx in range(40):
+            self.save(idx)
+        family_index = FamilyIndex.for_db(self.graph_db)
+        self.assertEqual(family_index.sync(self.graph_db), 40)
+        self.save(40)
+        self.save(41)
+        # A few new families are loaded one by one, not by streaming every family
+        loaded = []
+        load = self.graph_db.load_family_features
+        self.graph_db.load_family_features = lambda e_md5: loaded.append(e_md5) or load(e_md5)
+        self.graph_db.iter_families = None
+        self.assertEqual(family_index.sync(self.graph_db), 2)
+        self.assertEqual(sorted(loaded), ['e40', 'e41'])
+        self.assertEqual(family_index.sync(self.graph_db), 0)
+        self.assertEqual(len(self.found(family_index)), 42)
+
+    def test_sync_emptied_db(self):
+        self.save(0)
+        family_index = FamilyIndex.for_db(self.graph_db)
+        family_index.sync(self.graph_db)
+        family_index.save()
+        self.graph_db.query("delete from results", ())
+        family_index.sync(self.graph_db)
+        family_index.save()
+        reloaded = FamilyIndex.for_db(self.graph_db)
+        reloaded.load()
+        self.assertEqual(len(reloaded), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import StringIO
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+from argparse import Namespace
+
+import main
+from storage import dbgw
+from process.parsers import parse
+from storage.index import FamilyIndex
+from tests import samples
+
+
+def slow_parse(path):
+    """ Stands in for a parser that catches Exception around each object, as
+    PDFMinerParser.dump does, on a sample that takes far longer than the timeout
+    """
+    end = time.time() + 10
+    while time.time() < end:
+        try:
+            time.sleep(0.01)
+        except Exception:
+            pass
+
+
+class TestParseJob(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = signal.getsignal(signal.SIGALRM)
+
+    def tearDown(self):
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, self.handler)
+
+    def test_timeout_stops_parse(self):
+        main.init_parse_job(slow_parse, 1)
+        start = time.time()
+        path, status, pdf = main.parse_job('slow.pdf')
+        self.assertEqual(status, dbgw.JobDb.TIMEOUT)
+        self.assertIsNone(pdf)
+        self.assertLess(time.time() - start, 3)
+
+    def test_archive_shares_trees(self):
+        dirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dirname)
+        xml_db = dbgw.XmlDb(os.path.join(dirname, 'xmldb.sqlite'))
+        self.assertTrue(xml_db.init(xml_db.table, xml_db.cols))
+        self.addCleanup(xml_db.close)
+        main.init_parse_job(parse.get_parser('pdfminer'), 10, archive=True)
+        paths = [samples.write_pdf(dirname, name) for name in ('first.pdf', 'copy.pdf')]
+        for path in paths:
+            path, status, pdf = main.parse_job(path)
+            self.assertEqual(status, dbgw.JobDb.COMPLETE)
+            xml_db.save_tree(pdf.name, *pdf.tree, path=path)
+        # Samples at different paths with the same objects share one tree
+        self.assertEqual(xml_db.query("select count(*) from trees", ()), [(1,)])
+        self.assertEqual(sorted(xml_db.query("select path from pdf_trees", ())), sorted((path,) for path in paths))
+        xml = xml_db.load('first.pdf')
+        self.assertTrue(xml.startswith('<pdf'))
+        self.assertNotIn(dirname, xml)
+
+
+class TestScoreIndex(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.dirname = tempfile.mkdtemp()
+        self.graph_db = dbgw.GraphDb(os.path.join(self.dirname, 'graphdb.sqlite'))
+        self.graph_db.init(self.graph_db.table, self.graph_db.cols)
+
+    def tearDown(self):
+        self.graph_db.close()
+        shutil.rmtree(self.dirname)
+        logging.disable(logging.NOTSET)
+
+    def score(self, paths, thresh=0, knn=0):
+        fin = os.path.join(self.dirname, 'todo.txt')
+        with open(fin, 'w') as fout:
+            fout.write('\n'.join(paths))
+        argv = Namespace(parser='pdfminer', cache_mb=64, mapped=False, batch=False, fin=fin, thresh=thresh, knn=knn,
+                         reindex=False)
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            main.score_pdfs(argv, None, self.graph_db)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_unparsable_sample(self):
+        first = samples.write_pdf(self.dirname, 'first.pdf')
+        bad = samples.write_bad_pdf(self.dirname, 'bad.pdf')
+        second = samples.write_pdf(self.dirname, 'second.pdf',
+                                   samples.CATALOG[:3] + ["<< /S /JavaScript /JS (x) >>"])
+        self.score([first], thresh=100)
+        for kwargs in ({'thresh': 100}, {'knn': 5}):
+            out = self.score([bad, second], **kwargs)
+            self.assertIn("second.pdf,", out)
+            self.assertNotIn("bad.pdf,", out)
+
+        family_index = FamilyIndex.for_db(self.graph_db)
+        self.assertTrue(family_index.load())
+        self.assertEqual(set(pdf_id for e_md5, pdf_id in family_index.tree.keys),
+                         set(['first.pdf', 'second.pdf']))
+        self.assertFalse(family_index.insert('e_md5', 'bad.pdf', []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import httplib
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import main
+from process import serve
+from storage import dbgw
+from tests import samples
+from tests.test_main import slow_parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.sock_path = os.path.join(self.dirname, 'nabu.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def request(self, line):
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.sock_path)
+        try:
+            conn.sendall(line + '\n')
+            return json.loads(conn.makefile().readline())
+        finally:
+            conn.close()
+
+    def test_sigterm_removes_socket(self):
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py'), 'serve', '--dbdir', self.dirname,
+                                   '--logdir', self.dirname, '--socket', self.sock_path], cwd=ROOT)
+        try:
+            deadline = time.time() + 30
+            while not os.path.exists(self.sock_path) and time.time() < deadline and server.poll() is None:
+                time.sleep(0.1)
+            self.assertTrue(os.path.exists(self.sock_path))
+            self.assertEqual(self.request('{"features": []}'), {"subject": "", "error": "bad features"})
+
+            server.send_signal(signal.SIGTERM)
+            deadline = time.time() + 10
+            while server.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertEqual(server.poll(), 0)
+            self.assertFalse(os.path.exists(self.sock_path))
+        finally:
+            if server.poll() is None:
+                server.kill()
+                server.wait()
+
+
+class TestScorer(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.handler = signal.getsignal(signal.SIGALRM)
+        self.dirname = tempfile.mkdtemp()
+        self.graph_db = dbgw.GraphDb(os.path.join(self.dirname, 'graphdb.sqlite'))
+        self.graph_db.init(self.graph_db.table, self.graph_db.cols)
+
+    def tearDown(self):
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, self.handler)
+        self.graph_db.close()
+        shutil.rmtree(self.dirname)
+        logging.disable(logging.NOTSET)
+
+    def test_parse_timeout(self):
+        main.init_parse_job(slow_parse, 1)
+        scorer = serve.Scorer(self.graph_db, main.parse_job)
+        path = samples.write_pdf(self.dirname, 'slow.pdf')
+        start = time.time()
+        self.assertEqual(scorer.score_pdf(path), {"subject": "slow.pdf", "error": "parse timeout"})
+        self.assertLess(time.time() - start, 3)
+
+    def test_bad_content_length(self):
+        server = serve.HTTPScoreServer(0, serve.Scorer(self.graph_db, main.parse_job))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            for length in ('x', '-1'):
+                conn = httplib.HTTPConnection(*server.server_address)
+                conn.putrequest('POST', '/')
+                conn.putheader('Content-Length', length)
+                conn.endheaders()
+                self.assertEqual(conn.getresponse().status, 400)
+                conn.close()
+            conn = httplib.HTTPConnection(*server.server_address)
+            conn.request('POST', '/', '{"features": []}')
+            self.assertEqual(json.loads(conn.getresponse().read()), {"subject": "", "error": "bad features"})
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+try:
+    from storage import storage
+except ImportError as e:
+    # storage.py needs psycopg2 and db_mgmt.DBGateway
+    storage = None
+    MISSING = str(e)
+else:
+    MISSING = ''
+
+
+@unittest.skipIf(storage is None, MISSING)
+class TestDbStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.name = os.path.join(self.dirname, 'parsed')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def open_storage(self, batch=0, compress=()):
+        db = storage.StorageFactory().new_storage('sqlite3', self.name, batch=batch, compress=compress)
+        self.assertTrue(db.open())
+        return db
+
+    def count(self):
+        conn = sqlite3.connect(self.name + '.sqlite')
+        try:
+            return conn.execute("SELECT count(*) FROM %s" % storage.TABLE).fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_batch(self):
+        db = self.open_storage(batch=3)
+        for idx in range(4):
+            db.store({'pdf_md5': 'md5-%d' % idx, 'category': 'test'})
+        self.assertEqual(self.count(), 3)
+        self.assertEqual(len(db.pending), 1)
+        db.close()
+        self.assertEqual(self.count(), 4)
+
+    def test_error_rows(self):
+        db = self.open_storage(batch=3)
+        db.store({'pdf_md5': 'good-1', 'category': 'test'})
+        # sqlite can not bind a dict, so the batch fails and is retried row by row
+        db.store({'pdf_md5': 'bad', 'category': {'not': 'bound'}})
+        db.store({'pdf_md5': 'good-2', 'category': 'test'})
+        self.assertEqual(db.load('good-1')['category'], 'test')
+        self.assertEqual(db.load('good-2')['category'], 'test')
+        self.assertTrue(db.load('bad')['errors'].startswith('DB_ERROR: '))
+        db.close()
+
+    def test_compress_round_trip(self):
+        db = self.open_storage(batch=2, compress=storage.LARGE_COLUMNS)
+        tree = '<pdf>%s</pdf>' % ('<object/>' * 1000)
+        db.store({'pdf_md5': 'ascii', 'tree': tree, 'swf': '', 'urls': 'http://example.com/'})
+        db.store({'pdf_md5': 'unicode', 'tree': u'\xe9t\xe9', 'graph': '\x00\xff'})
+        db.close()
+
+        db = self.open_storage()
+        row = db.load('ascii')
+        self.assertEqual(row['tree'], tree)
+        self.assertEqual(row['swf'], '')
+        self.assertEqual(row['urls'], 'http://example.com/')
+        row = db.load('unicode')
+        self.assertEqual(row['tree'].decode('utf-8'), u'\xe9t\xe9')
+        self.assertEqual(row['graph'], '\x00\xff')
+        self.assertEqual(db.load('missing'), {})
+        db.close()
+
+    def test_decompress_plain_values(self):
+        self.assertEqual(storage.decompress('text'), 'text')
+        self.assertEqual(storage.decompress(buffer('not zlib')), 'not zlib')
+        self.assertIsNone(storage.decompress(None))
+
+
+@unittest.skipIf(storage is None, MISSING)
+class TestPostgresStorage(unittest.TestCase):
+
+    # The COPY tests run against the database named by NABU_TEST_PG_DB, as
+    # NABU_TEST_PG_USER, in a schema of their own that is dropped afterwards.
+    # libpq reads the host and port from PGHOST and PGPORT.
+    PG_DB = os.environ.get('NABU_TEST_PG_DB', '')
+    PG_USER = os.environ.get('NABU_TEST_PG_USER', '')
+    PG_PASSWORD = os.environ.get('NABU_TEST_PG_PASSWORD', '')
+    SCHEMA = 'nabu_unittest_%d' % os.getpid()
+
+    def test_copy_field(self):
+        copy_field = storage.PostgresStorage.copy_field
+        self.assertEqual(copy_field(None), '\\N')
+        self.assertEqual(copy_field(''), '')
+        self.assertEqual(copy_field('a\tb\nc\rd\\e'), 'a\\tb\\nc\\rd\\\\e')
+        self.assertEqual(copy_field('\\N'), '\\\\N')
+        self.assertEqual(copy_field(u'caf\xe9'), 'caf\xc3\xa9')
+        self.assertEqual(copy_field(12), '12')
+        # No raw separator survives, so each row stays one line of len(COLUMNS) fields
+        row = '\t'.join(copy_field(value) for value in ('\t', '\n', '\\', None, 'x'))
+        self.assertEqual(len(row.split('\t')), 5)
+        self.assertNotIn('\n', row)
+
+    def connect(self):
+        return storage.psycopg2.connect(database=self.PG_DB, user=self.PG_USER, password=self.PG_PASSWORD)
+
+    def execute(self, cmd):
+        conn = self.connect()
+        with conn:
+            conn.cursor().execute(cmd)
+        conn.close()
+
+    def open_storage(self, batch):
+        if not self.PG_DB:
+            self.skipTest("set NABU_TEST_PG_DB and NABU_TEST_PG_USER to run against postgres")
+        try:
+            self.execute("CREATE SCHEMA %s" % self.SCHEMA)
+        except storage.psycopg2.Error as e:
+            self.skipTest("no postgres database %s for user %s: %s" % (self.PG_DB, self.PG_USER, e))
+        self.addCleanup(self.execute, "DROP SCHEMA %s CASCADE" % self.SCHEMA)
+        # Every connection made while the test runs creates and fills parsed_pdfs in SCHEMA
+        options = os.environ.get('PGOPTIONS')
+        os.environ['PGOPTIONS'] = '-c search_path=%s' % self.SCHEMA
+        self.addCleanup(self.restore_options, options)
+        db = storage.PostgresStorage(self.PG_DB, self.PG_USER, self.PG_PASSWORD, batch=batch)
+        self.assertTrue(db.open())
+        self.addCleanup(db.conn.close)
+        return db
+
+    @staticmethod
+    def restore_options(options):
+        if options is None:
+            os.environ.pop('PGOPTIONS', None)
+        else:
+            os.environ['PGOPTIONS'] = options
+
+    def stored(self, db):
+        cur = db.conn.cursor()
+        cur.execute("SELECT pdf_md5, errors FROM %s.parsed_pdfs ORDER BY pdf_md5" % self.SCHEMA)
+        return cur.fetchall()
+
+    def test_copy_batch(self):
+        db = self.open_storage(batch=3)
+        values = ['tab\there', 'new\nline\r', 'back\\slash', '\\N', u'caf\xe9']
+        for idx, value in enumerate(values):
+            db.store({'pdf_md5': 'md5-%d' % idx, 'errors': value})
+        self.assertEqual(len(db.pending), 2)
+        self.assertEqual(db.flush(), 2)
+        values[-1] = values[-1].encode('utf-8')
+        self.assertEqual(self.stored(db), [('md5-%d' % idx, value) for idx, value in enumerate(values)])
+
+    def test_copy_falls_back_to_rows(self):
+        db = self.open_storage(batch=10)
+        db.store({'pdf_md5': 'md5-0', 'errors': 'ok'})
+        # postgres text can not hold NUL, the COPY fails and only this row is dropped
+        db.store({'pdf_md5': 'md5-1', 'errors': 'nul\x00'})
+        db.store({'pdf_md5': 'md5-2', 'errors': 'ok'})
+        self.assertEqual(db.flush(), 2)
+        self.assertEqual(self.stored(db), [('md5-0', 'ok'), ('md5-2', 'ok')])
+
+if __name__ == '__main__':
+    unittest.main()